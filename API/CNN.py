@@ -1,3 +1,4 @@
+import io
 import os
 import warnings
 
@@ -7,16 +8,74 @@ import torch
 import torchvision.models as models
 import torchvision.transforms as transforms
 from PIL import Image
-from scipy.spatial.distance import cosine
 from sklearn.cluster import DBSCAN
 
+from API.batching import MicroBatcher
+from API.feature_cache import FeatureCache, hash_image
+from API.model_registry import model_registry
+
 warnings.filterwarnings("ignore", category=UserWarning, module="torchvision")
 
+VGG16_MODEL_NAME = "vgg16"
+
+# Maximum number of images in one VGG16 forward pass
+VGG16_MAX_BATCH_SIZE = int(os.getenv("VGG16_MAX_BATCH_SIZE", 8))
+
+# Time to collect query images of concurrent requests into one micro-batch
+# and the number of images that ends the collection early, the collected
+# images still go through VGG16 in passes of VGG16_MAX_BATCH_SIZE
+VGG16_BATCH_WINDOW_MS = float(os.getenv("VGG16_BATCH_WINDOW_MS", 10))
+VGG16_BATCH_MAX_IMAGES = int(os.getenv("VGG16_BATCH_MAX_IMAGES", 16))
+
+# Bounds of the caches of query features and top N matches by image hash,
+# a size of 0 disables a cache
+FEATURE_CACHE_ENTRIES = int(os.getenv("FEATURE_CACHE_ENTRIES", 256))
+FEATURE_CACHE_MAX_MB = float(os.getenv("FEATURE_CACHE_MAX_MB", 64))
+MATCH_CACHE_ENTRIES = int(os.getenv("MATCH_CACHE_ENTRIES", 1024))
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", 3600))
+
+# Image transformation matching the input VGG16 was trained on
+VGG16_TRANSFORM = transforms.Compose(
+    [
+        transforms.Resize((224, 224)),
+        transforms.ToTensor(),
+        transforms.Normalize(
+            mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]
+        ),
+    ]
+)
+
+
+# Load the pretrained VGG16 model without its classification layer
+def load_vgg16_backbone():
+    model = models.vgg16(pretrained=True)
+    model = torch.nn.Sequential(
+        *list(model.children())[:-1]
+    )  # Remove the classification layer
+    model.eval()
+    return model
+
+
+model_registry.register(VGG16_MODEL_NAME, load_vgg16_backbone)
+
+
+# Return the shared VGG16 backbone and its transform, loading it on first use
+def get_vgg16_model():
+    return model_registry.get(VGG16_MODEL_NAME), VGG16_TRANSFORM
+
+
+# Load the VGG16 backbone and run one dummy forward pass
+def warm_up_vgg16_model():
+    def run_dummy_batch(model):
+        with torch.no_grad():
+            model(torch.zeros((1, 3, 224, 224)))
+
+    model_registry.warm_up(VGG16_MODEL_NAME, run_dummy_batch)
+
 
 # Extract image features using the VGG16 model
-def extract_vgg16_features(image_path, model, transform):
-    img = Image.open(image_path).convert("RGB")
-    img = transform(img)
+def extract_vgg16_features(image, model, transform):
+    img = load_image_tensor(image, transform)
     img = img.unsqueeze(0)  # Add batch dimension
 
     # Extract features
@@ -29,25 +88,218 @@ def extract_vgg16_features(image_path, model, transform):
     return features
 
 
-# Function to extract coordinates from CSV based on matching image name
-def extract_coordinates_from_match(ref_image_path, csv_path):
-    # Load the CSV file
+# Open an image given as a path, raw bytes, a file-like object or PIL image
+def open_image(image):
+    if isinstance(image, Image.Image):
+        return image.convert("RGB")
+
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        image = io.BytesIO(image)
+
+    return Image.open(image).convert("RGB")
+
+
+# Name of a query image for logging, whatever form the image is given in
+def get_image_name(image, index):
+    if isinstance(image, (str, os.PathLike)):
+        return os.path.basename(image)
+
+    # File objects can carry a name, temporary files only a descriptor
+    name = getattr(image, "name", None)
+    return name if isinstance(name, str) else f"query image {index}"
+
+
+# Decode an image and transform it into a VGG16 input tensor
+def load_image_tensor(image, transform):
+    img = open_image(image)
+    return transform(img)
+
+
+# Extract the features of several images with batched forward passes
+def extract_vgg16_features_batch(
+    images, model, transform, max_batch_size=VGG16_MAX_BATCH_SIZE
+):
+    """
+    Accepts image paths, raw bytes, file-like objects or PIL images.
+
+    Returns a float32 array of shape (n_images, n_features) with the same
+    rows `extract_vgg16_features` gives for every image on its own.
+    """
+    tensors = [load_image_tensor(image, transform) for image in images]
+    return run_vgg16_batches(tensors, model, max_batch_size)
+
+
+# Run VGG16 input tensors through the model in batched forward passes
+def run_vgg16_batches(tensors, model, max_batch_size=VGG16_MAX_BATCH_SIZE):
+    if not tensors:
+        return np.empty((0, 0), dtype=np.float32)
+
+    features = []
+    for start in range(0, len(tensors), max_batch_size):
+        batch = torch.stack(tensors[start : start + max_batch_size])
+
+        with torch.no_grad():
+            batch_features = model(batch)
+
+        features.append(batch_features.flatten(start_dim=1).numpy())
+
+    return np.concatenate(features)
+
+
+# Forward passes of one micro-batch collected from concurrent requests
+def run_shared_vgg16_batch(tensors):
+    model, _ = get_vgg16_model()
+    return run_vgg16_batches(tensors, model, VGG16_MAX_BATCH_SIZE)
+
+
+# Query images of concurrent requests share forward passes, unless the
+# batching window is set to 0
+vgg16_batcher = (
+    MicroBatcher(
+        run_shared_vgg16_batch, VGG16_BATCH_MAX_IMAGES, VGG16_BATCH_WINDOW_MS
+    )
+    if VGG16_BATCH_WINDOW_MS > 0
+    else None
+)
+
+
+# Repeated query images skip decoding and VGG16, or the search as well
+query_feature_cache = FeatureCache(
+    FEATURE_CACHE_ENTRIES,
+    int(FEATURE_CACHE_MAX_MB * 2**20),
+    QUERY_CACHE_TTL,
+)
+match_cache = FeatureCache(
+    MATCH_CACHE_ENTRIES,
+    int(FEATURE_CACHE_MAX_MB * 2**20),
+    QUERY_CACHE_TTL,
+)
+
+
+# Scale feature vectors to unit length so cosine similarity is a dot product
+def normalize_features(features):
+    features = np.asarray(features, dtype=np.float32)
+    norms = np.linalg.norm(features, axis=-1, keepdims=True)
+
+    # Zero vectors stay zero instead of turning into NaN
+    return features / np.maximum(norms, np.finfo(np.float32).tiny)
+
+
+# Stack the reference feature vectors into one contiguous float32 matrix
+# with L2-normalized rows, built once when the reference data is loaded
+def build_reference_matrix(ref_vgg16_features):
+    ref_matrix = np.asarray(ref_vgg16_features, dtype=np.float32)
+    ref_matrix = ref_matrix.reshape(len(ref_matrix), -1)
+    return np.ascontiguousarray(normalize_features(ref_matrix))
+
+
+# Find the top N reference rows for every query with one matrix product
+def find_top_matches(query_features, ref_matrix, top_n_matches):
+    """
+    Returns the indices of the best matching rows of `ref_matrix` and their
+    cosine distances, both of shape (n_queries, top_n_matches) and sorted
+    from best to worst match.
+    """
+    queries = normalize_features(np.atleast_2d(query_features))
+    similarities = queries @ ref_matrix.T
+
+    n_refs = ref_matrix.shape[0]
+    top_n_matches = min(top_n_matches, n_refs)
+
+    # Select the top N unordered, then only sort those N
+    if top_n_matches < n_refs:
+        candidates = np.argpartition(
+            -similarities, top_n_matches - 1, axis=1
+        )[:, :top_n_matches]
+    else:
+        candidates = np.tile(np.arange(n_refs), (len(queries), 1))
+
+    candidate_similarities = np.take_along_axis(
+        similarities, candidates, axis=1
+    )
+    order = np.argsort(-candidate_similarities, axis=1, kind="stable")
+
+    indices = np.take_along_axis(candidates, order, axis=1)
+    distances = 1.0 - np.take_along_axis(
+        candidate_similarities, order, axis=1
+    )
+    return indices, distances
+
+
+# Score a short list of candidate rows per query exactly and keep the top N
+def rerank_top_matches(query_features, ref_matrix, candidates, top_n_matches):
+    """
+    `candidates` holds one array of row indices of `ref_matrix` per query,
+    e.g. from an ANN index or a quantized search. Returns indices and
+    cosine distances in the format of `find_top_matches`.
+    """
+    queries = normalize_features(np.atleast_2d(query_features))
+    top_n_matches = min([top_n_matches] + [len(rows) for rows in candidates])
+
+    indices = np.empty((len(queries), top_n_matches), dtype=np.int64)
+    distances = np.empty((len(queries), top_n_matches), dtype=np.float32)
+
+    for query_index, query in enumerate(queries):
+        # Sorted rows keep the reads of a memory-mapped matrix sequential
+        rows = np.sort(candidates[query_index])
+        row_indices, row_distances = find_top_matches(
+            query, ref_matrix[rows], top_n_matches
+        )
+        indices[query_index] = rows[row_indices[0]]
+        distances[query_index] = row_distances[0]
+
+    return indices, distances
+
+
+# Base name of the SLAM image a reference view was cut from
+def get_slam_image_name(ref_image_path):
+    # Remove the _front, _left, ... suffixes of the cube map views
+    return os.path.basename(ref_image_path).split("_")[0] + ".jpg"
+
+
+# Load the SLAM coordinates CSV once into a {image name: (X, Y)} index
+def load_slam_coordinates(csv_path):
     coordinates_df = pd.read_csv(csv_path)
 
-    # Extract the base part of the image name (remove _front, _left suffixes)
-    base_name = os.path.basename(ref_image_path).split("_")[0] + ".jpg"
+    # Keep the first row of every image, like the old per-match lookup did
+    coordinates_df = coordinates_df.drop_duplicates("Image", keep="first")
+
+    return dict(
+        zip(
+            coordinates_df["Image"],
+            zip(
+                coordinates_df["X"].astype(float),
+                coordinates_df["Y"].astype(float),
+            ),
+        )
+    )
+
+
+# Build the (X, Y) coordinates of every row of the reference feature matrix
+def build_reference_coordinates(ref_image_paths, csv_path):
+    """
+    Returns a float64 array of shape (n_refs, 2) aligned with the rows of
+    the reference feature matrix, so a match index is directly a coordinate.
+    Reference images without coordinates get (0.0, 0.0).
+    """
+    slam_coordinates = load_slam_coordinates(csv_path)
+    ref_coordinates = np.zeros((len(ref_image_paths), 2), dtype=np.float64)
+    missing_images = []
 
-    # Find the corresponding image coordinates
-    row = coordinates_df[coordinates_df["Image"] == base_name]
+    for i, ref_image_path in enumerate(ref_image_paths):
+        base_name = get_slam_image_name(ref_image_path)
+        if base_name in slam_coordinates:
+            ref_coordinates[i] = slam_coordinates[base_name]
+        else:
+            missing_images.append(base_name)
 
-    if row.empty:
-        print(f"Coordinates not found for image: {base_name}")
-        return (0.0, 0.0)  # Return (0.0, 0.0) if coordinates are not found
+    if missing_images:
+        print(
+            f"Coordinates not found for {len(missing_images)} reference "
+            f"images: {sorted(set(missing_images))}"
+        )
 
-    # Extract X, Y coordinates
-    x = row["X"].values[0]
-    y = row["Y"].values[0]
-    return (x, y)
+    return ref_coordinates
 
 
 # Perform DBSCAN clustering and return the coordinates of the largest cluster's center
@@ -83,65 +335,103 @@ def apply_dbscan_and_find_center(all_coords, eps=2, min_samples=3):
     return largest_cluster_center
 
 
-# Load preprocessed reference data and match query images
+# VGG16 features of query images, taken from the cache for images seen before
+def get_query_features(
+    query_images, image_hashes, max_batch_size=VGG16_MAX_BATCH_SIZE
+):
+    query_features = [query_feature_cache.get(h) for h in image_hashes]
+    missing = [i for i, f in enumerate(query_features) if f is None]
+    if not missing:
+        return np.stack(query_features)
+
+    # Get the VGG16 model shared by all requests
+    model, transform = get_vgg16_model()
+    missing_images = [query_images[i] for i in missing]
+
+    # Extract VGG16 features for the new images in batched forward passes,
+    # shared with other requests through the micro-batcher when enabled and
+    # its forward passes have the requested size
+    if vgg16_batcher is not None and max_batch_size == VGG16_MAX_BATCH_SIZE:
+        features = vgg16_batcher.run(
+            [load_image_tensor(image, transform) for image in missing_images]
+        )
+    else:
+        features = extract_vgg16_features_batch(
+            missing_images, model, transform, max_batch_size
+        )
+
+    # Copy the rows so the cache does not keep whole batches alive
+    for i, feature in zip(missing, features):
+        query_features[i] = np.array(feature, dtype=np.float32)
+        query_feature_cache.put(image_hashes[i], query_features[i])
+
+    return np.stack(query_features)
+
+
+# Match query images (paths or in-memory buffers) against a reference
+# FeatureStore from API.feature_store, optionally only against the rows in
+# candidate_rows
 def match_query_images_and_get_center(
-    query_image_paths,
-    ref_vgg16_features,
-    ref_image_paths,
-    csv_path,
+    query_images,
+    reference_store,
     top_n_matches=6,
     min_DBSCAN_samples=3,
+    max_batch_size=VGG16_MAX_BATCH_SIZE,
+    candidate_rows=None,
 ):
-    # Load the VGG16 model
-    model = models.vgg16(pretrained=True)
-    model = torch.nn.Sequential(
-        *list(model.children())[:-1]
-    )  # Remove the classification layer
-    model.eval()
+    all_coords = []  # To store all matched image coordinates
 
-    # Define image transformation
-    transform = transforms.Compose(
-        [
-            transforms.Resize((224, 224)),
-            transforms.ToTensor(),
-            transforms.Normalize(
-                mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]
-            ),
-        ]
-    )
+    # Repeated images are recognised by the hash of their encoded bytes
+    image_hashes = [hash_image(image) for image in query_images]
 
-    all_coords = []  # To store all matched image coordinates
+    # Top N matches of images searched before against the same store
+    store_key = reference_store.build_id or id(reference_store)
+    match_keys = [
+        (
+            (image_hash, store_key, top_n_matches)
+            if image_hash is not None and candidate_rows is None
+            else None
+        )
+        for image_hash in image_hashes
+    ]
+    matches = [match_cache.get(key) for key in match_keys]
+    to_search = [i for i, match in enumerate(matches) if match is None]
 
-    # Process each query image
-    for query_image_path in query_image_paths:
-        print(
-            f"Processing query image:\t\t{os.path.basename(query_image_path)}"
+    if to_search:
+        query_features = get_query_features(
+            [query_images[i] for i in to_search],
+            [image_hashes[i] for i in to_search],
+            max_batch_size,
         )
 
-        # Extract VGG16 features for the query image
-        query_features = extract_vgg16_features(
-            query_image_path, model, transform
+        # Compare all remaining query images with the reference features
+        indices, distances = reference_store.search(
+            query_features, top_n_matches, candidate_rows=candidate_rows
         )
+        for row, i in enumerate(to_search):
+            matches[i] = (indices[row].copy(), distances[row].copy())
+            match_cache.put(match_keys[i], matches[i])
 
-        # Load saved reference data
-        # with open(reference_data_file, "rb") as f:
-        #     ref_image_paths, ref_vgg16_features = pickle.load(f)
+    indices = np.stack([match[0] for match in matches])
+    distances = np.stack([match[1] for match in matches])
 
-        # Compare query image with reference images' VGG16 feature vectors
-        distances = []
-        for i, ref_features in enumerate(ref_vgg16_features):
-            distance = cosine(query_features, ref_features)
-            distances.append((distance, os.path.basename(ref_image_paths[i])))
+    # Process each query image
+    for query_index, query_image in enumerate(query_images):
+        print(
+            "Processing query image:\t\t"
+            f"{get_image_name(query_image, query_index)}"
+        )
 
-        # Sort and get the top N matches
-        distances.sort(key=lambda x: x[0])
-        best_matches = distances[:top_n_matches]
+        best_matches = [
+            (float(distance), reference_store.image_names[i])
+            for distance, i in zip(
+                distances[query_index], indices[query_index]
+            )
+        ]
         print(f"best matches:\t\t{best_matches}")
 
-        # Extract coordinates for each matched image
-        for _, ref_image_path in best_matches:
-            coord = extract_coordinates_from_match(ref_image_path, csv_path)
-            all_coords.append(coord)
+        # Look up the coordinates of each matched image by its row
+        all_coords.extend(reference_store.coordinates[indices[query_index]])
 
     # Perform DBSCAN clustering on all matched image coordinates and return the center of the largest cluster
     print("-" * 30)
@@ -0,0 +1,193 @@
+import os
+
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+
+from API.CNN import normalize_features, rerank_top_matches
+
+# Number of inverted lists scanned per query, more lists trade speed for
+# recall
+ANN_NPROBE = int(os.getenv("ANN_NPROBE", 8))
+
+# Stores with fewer rows are searched exactly, brute force is cheap there
+# and an index would only lose recall
+ANN_MIN_ROWS = int(os.getenv("ANN_MIN_ROWS", 50_000))
+
+# Rows used to fit the cluster centroids of large stores
+IVF_TRAINING_SAMPLE = 50_000
+
+# Rows compared with the centroids at once while assigning lists
+IVF_ASSIGN_CHUNK = 4096
+
+
+class IVFIndex:
+    """
+    Inverted file index over the normalized reference matrix.
+
+    Every reference row belongs to the list of its closest centroid. A
+    query is compared with the centroids first and only the rows of the
+    `nprobe` closest lists are scored exactly, so the work per query grows
+    with the list size instead of the number of reference images. The
+    rows are read from `features`, which can stay memory-mapped.
+    """
+
+    kind = "ivf"
+
+    def __init__(self, features, centroids, list_offsets, list_ids, nprobe):
+        self.features = features
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+        self.nprobe = nprobe
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    def probe(self, query_features, nprobe=None, min_rows: int = 0):
+        """
+        Returns the reference rows in the `nprobe` closest lists of every
+        query, or all rows when those lists hold fewer than `min_rows`.
+        """
+        queries = normalize_features(np.atleast_2d(query_features))
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+
+        # Closest lists of every query
+        probed_lists = np.argsort(-(queries @ self.centroids.T), axis=1)
+
+        candidates = []
+        for lists in probed_lists:
+            rows = np.concatenate(
+                [
+                    self.list_ids[
+                        self.list_offsets[i] : self.list_offsets[i + 1]
+                    ]
+                    for i in lists[:nprobe]
+                ]
+            )
+
+            # Too few rows in the probed lists, score all of them
+            if len(rows) < min_rows:
+                rows = np.arange(len(self.features))
+            candidates.append(rows)
+
+        return candidates
+
+    def search(self, query_features, top_n_matches: int, nprobe=None):
+        """
+        Returns the row indices and cosine distances of the approximate top
+        N reference images, in the format of `find_top_matches`.
+        """
+        top_n_matches = min(top_n_matches, len(self.features))
+        candidates = self.probe(query_features, nprobe, top_n_matches)
+        return rerank_top_matches(
+            query_features, self.features, candidates, top_n_matches
+        )
+
+    def stats(self) -> dict:
+        list_sizes = np.diff(self.list_offsets)
+        return {
+            "kind": self.kind,
+            "count": len(self.list_ids),
+            "nlist": self.nlist,
+            "nprobe": self.nprobe,
+            "largest_list": int(list_sizes.max(initial=0)),
+        }
+
+    def save(self, path: str):
+        np.savez(
+            path,
+            kind=np.array(self.kind),
+            centroids=self.centroids,
+            list_offsets=self.list_offsets,
+            list_ids=self.list_ids,
+        )
+
+    @classmethod
+    def load(cls, path: str, features, nprobe: int = ANN_NPROBE):
+        with np.load(path) as arrays:
+            if str(arrays["kind"]) != cls.kind:
+                raise ValueError(
+                    f"'{path}' holds a {arrays['kind']} index, not {cls.kind}."
+                )
+
+            return cls(
+                features,
+                arrays["centroids"],
+                arrays["list_offsets"],
+                arrays["list_ids"],
+                nprobe,
+            )
+
+
+# Index classes by the kind stored in their file, new kinds register here
+ANN_INDEX_TYPES = {IVFIndex.kind: IVFIndex}
+
+
+def load_ann_index(path: str, features, nprobe: int = ANN_NPROBE):
+    """
+    Load the index stored at `path` over the rows of `features`.
+    """
+    with np.load(path) as arrays:
+        kind = str(arrays["kind"])
+
+    if kind not in ANN_INDEX_TYPES:
+        raise ValueError(
+            f"Unsupported ANN index kind '{kind}'. "
+            f"Only {', '.join(ANN_INDEX_TYPES)} are supported."
+        )
+    return ANN_INDEX_TYPES[kind].load(path, features, nprobe)
+
+
+def build_ivf_index(features, nlist=None, nprobe: int = ANN_NPROBE):
+    """
+    Cluster the normalized reference rows into `nlist` inverted lists,
+    about sqrt(n) by default.
+    """
+    n_refs = len(features)
+    if nlist is None:
+        nlist = int(np.sqrt(n_refs))
+    nlist = max(1, min(nlist, n_refs))
+
+    # Fit the centroids on a sample, big stores do not fit in memory twice
+    sample = features
+    if n_refs > IVF_TRAINING_SAMPLE:
+        rng = np.random.default_rng(0)
+        sample = features[
+            np.sort(rng.choice(n_refs, IVF_TRAINING_SAMPLE, replace=False))
+        ]
+
+    kmeans = MiniBatchKMeans(n_clusters=nlist, random_state=0, n_init=3)
+    kmeans.fit(np.asarray(sample, dtype=np.float32))
+    centroids = normalize_features(kmeans.cluster_centers_)
+
+    # Assign every row to its closest centroid by cosine similarity
+    assignments = np.concatenate(
+        [
+            np.argmax(
+                features[start : start + IVF_ASSIGN_CHUNK] @ centroids.T,
+                axis=1,
+            )
+            for start in range(0, n_refs, IVF_ASSIGN_CHUNK)
+        ]
+    )
+
+    # Store the lists back to back, list i is list_ids[offsets[i]:offsets[i+1]]
+    list_ids = np.argsort(assignments, kind="stable").astype(np.int64)
+    list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+    list_offsets[1:] = np.cumsum(np.bincount(assignments, minlength=nlist))
+
+    print(
+        f"built ivf index with {nlist} lists over {n_refs} rows, "
+        f"largest list {np.diff(list_offsets).max()}"
+    )
+    return IVFIndex(features, centroids, list_offsets, list_ids, nprobe)
+
+
+# Fraction of the exact top N rows the approximate search found
+def recall_at_n(exact_indices, approximate_indices) -> float:
+    found = [
+        len(np.intersect1d(exact, approximate)) / len(exact)
+        for exact, approximate in zip(exact_indices, approximate_indices)
+    ]
+    return float(np.mean(found)) if found else 1.0
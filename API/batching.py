@@ -0,0 +1,119 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class MicroBatcher:
+    """
+    Collects inputs submitted by concurrent requests and runs them through
+    `batch_fn` together.
+
+    A background thread waits for the first submission, then keeps
+    collecting for at most `max_wait_ms` or until `max_batch_size` inputs
+    are waiting. `batch_fn` gets the list of all collected inputs and must
+    return one output row per input; the rows are handed back to the
+    requests that submitted them.
+    """
+
+    def __init__(self, batch_fn, max_batch_size: int = 16, max_wait_ms=10):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_ms / 1000
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker_pid = None
+        self._batches = 0
+        self._inputs = 0
+        self._largest_batch = 0
+
+    def submit(self, inputs: list) -> Future:
+        """
+        Queue `inputs` for the next batch and return a future of their
+        stacked outputs.
+        """
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((list(inputs), future))
+        return future
+
+    def run(self, inputs: list):
+        """
+        Run `inputs` in the next batch and wait for their outputs.
+        """
+        return self.submit(inputs).result()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait_seconds * 1000,
+                "batches": self._batches,
+                "inputs": self._inputs,
+                "mean_batch_size": round(
+                    self._inputs / max(self._batches, 1), 2
+                ),
+                "largest_batch": self._largest_batch,
+                "waiting_requests": self._queue.qsize(),
+            }
+
+    def _ensure_worker(self):
+        # Threads do not survive a fork, so every process starts its own
+        with self._lock:
+            if self._worker_pid == os.getpid():
+                return
+            self._worker_pid = os.getpid()
+
+        threading.Thread(
+            target=self._run_worker, name="micro-batcher", daemon=True
+        ).start()
+
+    def _collect_batch(self):
+        batch = [self._queue.get()]
+        n_inputs = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait_seconds
+
+        while n_inputs < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+
+            batch.append(request)
+            n_inputs += len(request[0])
+
+        return batch
+
+    def _run_worker(self):
+        while True:
+            batch = self._collect_batch()
+            inputs = [
+                item for request_inputs, _ in batch for item in request_inputs
+            ]
+
+            try:
+                outputs = self.batch_fn(inputs)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            with self._lock:
+                self._batches += 1
+                self._inputs += len(inputs)
+                self._largest_batch = max(self._largest_batch, len(inputs))
+
+            # Hand every request the rows of its own inputs
+            start = 0
+            for request_inputs, future in batch:
+                end = start + len(request_inputs)
+                future.set_result(np.asarray(outputs[start:end]))
+                start = end
@@ -0,0 +1,403 @@
+import heapq
+import os
+
+import numpy as np
+
+# Contraction hierarchy file, stored next to the (first) nodes file
+CONTRACTION_FILE = "contraction.npz"
+
+# Penalty added to the weight of the edges of restricted rooms by every
+# routing engine, routes only cross restricted rooms when there is no other
+# way and then cross as few of their edges as possible
+RESTRICTED_EDGE_WEIGHT = 1e9
+
+
+class ContractionHierarchy:
+    """
+    Customizable contraction hierarchy over the edges of a routing graph.
+
+    Nodes are contracted in the order of `rank`. Contracting a node links
+    all of its remaining neighbors, so every pair of neighbors is joined by
+    an arc from the lower to the higher ranked node: an original edge
+    (`arc_edge` >= 0) or a shortcut (-1). The arcs leaving node i upwards
+    are `arc_head[up_indptr[i]:up_indptr[i + 1]]`.
+
+    The hierarchy does not depend on the edge weights. `customize` turns a
+    weight per edge into arc weights through the lower triangles of every
+    arc: arcs (w, u) and (w, v) with w ranked below u and v bound the
+    weight of (u, v). A shortest path query searches upwards from both
+    ends through the ancestors of the start and end in the elimination
+    tree.
+    """
+
+    def __init__(
+        self,
+        rank,
+        arc_tail,
+        arc_head,
+        arc_edge,
+        triangles,
+        arc_level,
+    ):
+        self.rank = rank
+        self.arc_tail = arc_tail
+        self.arc_head = arc_head
+        self.arc_edge = arc_edge
+        # (target arc, arc from the lowest node to the lower end of the
+        # target, arc from the lowest node to its higher end), sorted by
+        # target arc
+        self.triangles = triangles
+        self.arc_level = arc_level
+
+        n_nodes, n_arcs = len(rank), len(arc_tail)
+        self.up_indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+        self.up_indptr[1:] = np.cumsum(
+            np.bincount(arc_tail, minlength=n_nodes)
+        )
+        self.triangle_offsets = np.zeros(n_arcs + 1, dtype=np.int64)
+        self.triangle_offsets[1:] = np.cumsum(
+            np.bincount(triangles[:, 0], minlength=n_arcs)
+        )
+
+        # Customization relaxes the triangles of one arc level at a time,
+        # the arcs they read all have lower levels
+        order = np.argsort(arc_level[triangles[:, 0]], kind="stable")
+        levels = arc_level[triangles[order, 0]]
+        bounds = np.flatnonzero(np.diff(levels)) + 1
+        self._level_triangles = [
+            triangles[chunk]
+            for chunk in np.split(order, bounds)
+            if len(chunk)
+        ]
+
+        # Plain lists are faster than NumPy scalars in the search loop
+        self._up_indptr = self.up_indptr.tolist()
+        self._arc_head = arc_head.tolist()
+        self._arc_tail = arc_tail.tolist()
+        self._arc_edge = arc_edge.tolist()
+        self._triangle_offsets = self.triangle_offsets.tolist()
+        self._triangles = triangles.tolist()
+
+        # Parent of every node in the elimination tree: its lowest ranked
+        # upward neighbor, the arcs of a node are sorted by head rank
+        self._tree_parent = [
+            (
+                self._arc_head[self._up_indptr[u]]
+                if self._up_indptr[u] < self._up_indptr[u + 1]
+                else -1
+            )
+            for u in range(n_nodes)
+        ]
+
+    def stats(self) -> dict:
+        return {
+            "nodes": len(self.rank),
+            "arcs": len(self.arc_tail),
+            "shortcuts": int(np.sum(self.arc_edge < 0)),
+            "triangles": len(self.triangles),
+        }
+
+    def customize(self, edge_weights):
+        """
+        Returns the weight of every arc for a metric given as one weight
+        per edge of the graph the hierarchy was built from.
+        """
+        weights = np.full(len(self.arc_tail), np.inf)
+        original = self.arc_edge >= 0
+        weights[original] = np.asarray(edge_weights)[self.arc_edge[original]]
+
+        for triangles in self._level_triangles:
+            np.minimum.at(
+                weights,
+                triangles[:, 0],
+                weights[triangles[:, 1]] + weights[triangles[:, 2]],
+            )
+        return weights
+
+    def find_path(self, source: int, target: int, weights, edge_weights):
+        """
+        Returns the node indices of the shortest path between the node
+        indices `source` and `target` under the customized arc `weights`,
+        or None if there is no path.
+        """
+        if source == target:
+            return [source]
+
+        weights = (
+            weights.tolist() if isinstance(weights, np.ndarray) else weights
+        )
+        up_indptr, arc_head = self._up_indptr, self._arc_head
+
+        # Upward searches from both ends: the arcs leaving a node only lead
+        # to its ancestors in the elimination tree, so walking the ancestors
+        # in rank order settles them without a priority queue
+        distances, parents = [], []
+        for start in (source, target):
+            distance = {start: 0.0}
+            parent = {start: -1}
+            u = start
+            while u >= 0:
+                d = distance.get(u)
+                if d is not None:
+                    for arc in range(up_indptr[u], up_indptr[u + 1]):
+                        v = arc_head[arc]
+                        cost = d + weights[arc]
+                        if cost < distance.get(v, float("inf")):
+                            distance[v] = cost
+                            parent[v] = arc
+                u = self._tree_parent[u]
+            distances.append(distance)
+            parents.append(parent)
+
+        # The path meets at the common ancestor with the shortest total
+        best, meeting = float("inf"), None
+        for u, d in distances[0].items():
+            other = distances[1].get(u)
+            if other is not None and d + other < best:
+                best, meeting = d + other, u
+
+        if meeting is None:
+            return None
+
+        # Arcs from the source up to the meeting node and down to the target
+        up_arcs, down_arcs = [], []
+        for side, arcs in ((0, up_arcs), (1, down_arcs)):
+            node = meeting
+            while parents[side][node] >= 0:
+                arc = parents[side][node]
+                arcs.append(arc)
+                node = self._arc_tail[arc]
+        up_arcs.reverse()
+
+        path = [source]
+        for arc in up_arcs:
+            path.extend(self._unpack(arc, weights, edge_weights))
+        for arc in down_arcs:
+            path.extend(self._unpack(arc, weights, edge_weights, True))
+        return path
+
+    def _unpack(self, arc, weights, edge_weights, downward=False):
+        # Nodes after the first one on the original edges behind `arc`,
+        # from its tail to its head, or from its head to its tail
+        nodes = []
+        stack = [(arc, downward)]
+        while stack:
+            arc, downward = stack.pop()
+            weight = weights[arc]
+            edge = self._arc_edge[arc]
+            if edge >= 0 and edge_weights[edge] == weight:
+                nodes.append(
+                    self._arc_tail[arc] if downward else self._arc_head[arc]
+                )
+                continue
+
+            # The lower triangle the weight of the shortcut came from
+            for i in range(
+                self._triangle_offsets[arc], self._triangle_offsets[arc + 1]
+            ):
+                _, lower, upper = self._triangles[i]
+                if weights[lower] + weights[upper] == weight:
+                    break
+
+            # tail -> middle -> head runs down `lower` and up `upper`
+            if downward:
+                stack.append((lower, False))
+                stack.append((upper, True))
+            else:
+                stack.append((upper, False))
+                stack.append((lower, True))
+        return nodes
+
+    def save(self, path: str, source_hash: str):
+        np.savez_compressed(
+            path + ".tmp.npz",
+            source_hash=np.array(source_hash),
+            rank=self.rank,
+            arc_tail=self.arc_tail,
+            arc_head=self.arc_head,
+            arc_edge=self.arc_edge,
+            triangles=self.triangles,
+            arc_level=self.arc_level,
+        )
+        os.replace(path + ".tmp.npz", path)
+        print(f"contraction hierarchy saved to {path}")
+
+    @classmethod
+    def load(cls, path: str, source_hash: str):
+        """
+        Returns the hierarchy stored at `path`, or None when the file is
+        missing or built from other files.
+        """
+        if not os.path.exists(path):
+            return None
+
+        with np.load(path) as arrays:
+            if str(arrays["source_hash"]) != source_hash:
+                print(
+                    f"contraction hierarchy {path} is outdated, ignoring it"
+                )
+                return None
+
+            return cls(
+                arrays["rank"],
+                arrays["arc_tail"],
+                arrays["arc_head"],
+                arrays["arc_edge"],
+                arrays["triangles"],
+                arrays["arc_level"],
+            )
+
+
+# Node sets contracted in input order instead of being split further
+NESTED_DISSECTION_LEAF = 4
+
+
+def nested_dissection_order(positions, edge_nodes):
+    """
+    Returns the node indices in contraction order: the nodes are split in
+    two halves at the median of the coordinate of `positions` giving the
+    fewest separator nodes, the separator is contracted after both halves,
+    which are split the same way (geometric nested dissection). Separators
+    are small on building graphs, so few shortcuts are needed.
+    """
+    positions = np.asarray(positions, dtype=np.float64).reshape(
+        len(positions), -1
+    )
+    side = np.zeros(len(positions), dtype=bool)
+
+    def dissect(nodes, edges):
+        if len(nodes) <= NESTED_DISSECTION_LEAF or len(edges) == 0:
+            return nodes.tolist()
+
+        best = None
+        for axis in range(positions.shape[1]):
+            order = np.argsort(positions[nodes, axis], kind="stable")
+            side[nodes] = False
+            side[nodes[order[: len(nodes) // 2]]] = True
+
+            # Cover the crossing edges with the ends on one side
+            crossing = edges[side[edges[:, 0]] != side[edges[:, 1]]]
+            for first_half in (True, False):
+                ends = np.where(
+                    side[crossing[:, 0]] == first_half,
+                    crossing[:, 0],
+                    crossing[:, 1],
+                )
+                separator = np.unique(ends)
+                if best is None or len(separator) < len(best[1]):
+                    best = (side[nodes].copy(), separator)
+
+        in_first, separator = best
+        side[nodes] = in_first
+        side[separator] = False
+        in_separator = np.isin(nodes, separator)
+        first = nodes[in_first & ~in_separator]
+        second = nodes[~in_first & ~in_separator]
+
+        # Edges inside each half, the separator nodes are left out
+        kept = ~np.isin(edges, separator).any(axis=1)
+        edge_side = side[edges[kept, 0]]
+        return (
+            dissect(first, edges[kept][edge_side])
+            + dissect(second, edges[kept][~edge_side])
+            + separator.tolist()
+        )
+
+    edge_nodes = np.asarray(edge_nodes, dtype=np.int64).reshape(-1, 2)
+    return dissect(np.arange(len(positions)), edge_nodes)
+
+
+def build_contraction_hierarchy(n_nodes: int, edge_nodes, positions=None):
+    """
+    Contract the nodes of a graph given by its node count and the node
+    index pairs of its edges, in nested dissection order over the node
+    `positions`, or fewest neighbors first (minimum degree order) without
+    them.
+    """
+    adjacency = [set() for _ in range(n_nodes)]
+    for u, v in edge_nodes.tolist():
+        if u != v:
+            adjacency[u].add(v)
+            adjacency[v].add(u)
+
+    rank = np.empty(n_nodes, dtype=np.int64)
+    upward = [None] * n_nodes
+
+    # Contracting a node links its remaining neighbors
+    def contract(u, next_rank):
+        rank[u] = next_rank
+        upward[u] = neighbors = adjacency[u]
+        for v in neighbors:
+            adjacency[v].discard(u)
+            adjacency[v].update(neighbors)
+            adjacency[v].discard(v)
+        adjacency[u] = set()
+        return neighbors
+
+    if positions is not None:
+        for next_rank, u in enumerate(
+            nested_dissection_order(positions, edge_nodes)
+        ):
+            contract(u, next_rank)
+
+    else:
+        # Contract the node with the fewest remaining neighbors first
+        queue = [(len(neighbors), u) for u, neighbors in enumerate(adjacency)]
+        heapq.heapify(queue)
+        contracted = bytearray(n_nodes)
+        next_rank = 0
+        while queue:
+            degree, u = heapq.heappop(queue)
+            if contracted[u] or degree != len(adjacency[u]):
+                continue
+
+            contracted[u] = 1
+            for v in contract(u, next_rank):
+                heapq.heappush(queue, (len(adjacency[v]), v))
+            next_rank += 1
+
+    # Arcs sorted by tail node, then by the rank of the head
+    arc_pairs = [
+        (u, v)
+        for u in range(n_nodes)
+        for v in sorted(upward[u], key=lambda v: rank[v])
+    ]
+    arc_index = {pair: i for i, pair in enumerate(arc_pairs)}
+    arc_tail = np.array([u for u, _ in arc_pairs], dtype=np.int64)
+    arc_head = np.array([v for _, v in arc_pairs], dtype=np.int64)
+
+    arc_edge = np.full(len(arc_pairs), -1, dtype=np.int64)
+    for edge, (u, v) in enumerate(edge_nodes.tolist()):
+        if rank[u] > rank[v]:
+            u, v = v, u
+        if (u, v) in arc_index:
+            arc_edge[arc_index[u, v]] = edge
+
+    # Lower triangles in contraction order, so the level of the arcs they
+    # read is final: the level of an arc is one more than that of its
+    # lower triangle arcs, 0 without lower triangles
+    triangles = []
+    arc_level = np.zeros(len(arc_pairs), dtype=np.int64)
+    for w in np.argsort(rank).tolist():
+        neighbors = sorted(upward[w], key=lambda v: rank[v])
+        for i, u in enumerate(neighbors):
+            lower = arc_index[w, u]
+            for v in neighbors[i + 1 :]:
+                target, upper = arc_index[u, v], arc_index[w, v]
+                triangles.append((target, lower, upper))
+                arc_level[target] = max(
+                    arc_level[target],
+                    1 + max(arc_level[lower], arc_level[upper]),
+                )
+
+    triangles = np.array(triangles, dtype=np.int64).reshape(-1, 3)
+    triangles = triangles[np.argsort(triangles[:, 0], kind="stable")]
+
+    hierarchy = ContractionHierarchy(
+        rank, arc_tail, arc_head, arc_edge, triangles, arc_level
+    )
+    print(
+        f"contracted {n_nodes} nodes into {len(arc_pairs)} arcs, "
+        f"{hierarchy.stats()['shortcuts']} shortcuts"
+    )
+    return hierarchy
@@ -0,0 +1,114 @@
+import numpy as np
+from sklearn.decomposition import PCA
+
+from API.CNN import normalize_features
+
+# Channels of the flattened 512x7x7 VGG16 avgpool output
+VGG16_CHANNELS = 512
+
+# raw:     flattened 512x7x7 features (25,088 floats)
+# gap:     global average pooling over the 7x7 grid (512 floats)
+# pca:     PCA-whitening projection of the raw features
+# gap_pca: PCA-whitening projection of the pooled features
+EMBEDDING_HEADS = ("raw", "gap", "pca", "gap_pca")
+
+
+# Average every channel over its spatial grid
+def global_average_pool(features, channels=VGG16_CHANNELS):
+    features = np.atleast_2d(np.asarray(features, dtype=np.float32))
+    return features.reshape(len(features), channels, -1).mean(axis=2)
+
+
+class EmbeddingHead:
+    """
+    Maps flattened VGG16 features to the L2-normalized descriptors stored
+    in a feature store. Reference and query images have to go through the
+    same head to be comparable.
+    """
+
+    def __init__(self, name: str, pca_mean=None, pca_components=None):
+        if name not in EMBEDDING_HEADS:
+            raise ValueError(
+                f"Unsupported embedding head '{name}'. "
+                f"Only {', '.join(EMBEDDING_HEADS)} are supported."
+            )
+
+        if name.endswith("pca") and pca_components is None:
+            raise ValueError(f"Embedding head '{name}' needs a projection.")
+
+        self.name = name
+        self.pca_mean = pca_mean
+        self.pca_components = pca_components
+
+    @property
+    def uses_pca(self) -> bool:
+        return self.name.endswith("pca")
+
+    @property
+    def dim(self) -> int | None:
+        if self.uses_pca:
+            return len(self.pca_components)
+        return VGG16_CHANNELS if self.name == "gap" else None
+
+    def apply(self, features):
+        """
+        Returns the normalized descriptors of a batch of raw features.
+        """
+        # The projection is fitted on normalized reference features
+        features = normalize_features(np.atleast_2d(features))
+
+        if self.name.startswith("gap"):
+            features = global_average_pool(features)
+
+        if self.uses_pca:
+            # The whitening scale is folded into the components
+            features = (features - self.pca_mean) @ self.pca_components.T
+
+        return normalize_features(features)
+
+    def save(self, path: str):
+        arrays = {"name": np.array(self.name)}
+        if self.uses_pca:
+            arrays["pca_mean"] = self.pca_mean
+            arrays["pca_components"] = self.pca_components
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path) as arrays:
+            return cls(
+                str(arrays["name"]),
+                arrays.get("pca_mean"),
+                arrays.get("pca_components"),
+            )
+
+
+def fit_embedding_head(name: str, features, n_components: int = 256):
+    """
+    Create the embedding head `name`, fitting a PCA-whitening projection
+    on the reference features for the pca heads.
+    """
+    if not name.endswith("pca"):
+        return EmbeddingHead(name)
+
+    features = normalize_features(features)
+    if name == "gap_pca":
+        features = global_average_pool(features)
+
+    n_components = min(n_components, *features.shape)
+    pca = PCA(n_components=n_components, whiten=True, random_state=0)
+    pca.fit(features)
+
+    # Whitening divides every component by its standard deviation
+    scale = 1.0 / np.sqrt(np.maximum(pca.explained_variance_, 1e-12))
+    pca_components = pca.components_ * scale[:, np.newaxis]
+
+    print(
+        f"fitted {name} head with {n_components} components, explaining "
+        f"{pca.explained_variance_ratio_.sum():.1%} of the variance"
+    )
+    return EmbeddingHead(
+        name,
+        pca.mean_.astype(np.float32),
+        pca_components.astype(np.float32),
+    )
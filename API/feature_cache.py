@@ -0,0 +1,145 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+# Bytes hashed at once when reading files and spooled uploads
+HASH_CHUNK_SIZE = 1 << 20
+
+
+# SHA-256 of the encoded bytes of a query image, or None for decoded images
+def hash_image(image) -> str | None:
+    digest = hashlib.sha256()
+
+    if isinstance(image, (bytes, bytearray)):
+        digest.update(image)
+
+    elif isinstance(image, str):
+        with open(image, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+
+    elif hasattr(image, "read") and hasattr(image, "seek"):
+        # Hash from the current position and rewind for the decoder
+        position = image.tell()
+        for chunk in iter(lambda: image.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+        image.seek(position)
+
+    else:
+        return None
+
+    return digest.hexdigest()
+
+
+# Memory held by a cached value, counting the arrays it contains
+def _value_bytes(value) -> int:
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(_value_bytes(item) for item in value)
+    return 0
+
+
+class FeatureCache:
+    """
+    Thread-safe LRU cache with a time to live.
+
+    Holds at most `max_entries` values and `max_bytes` of array memory,
+    evicting the least recently used entries first. Entries older than
+    `ttl_seconds` are treated as missing. A cache with `max_entries=0`
+    stores nothing, `max_bytes=None` only limits the number of entries.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        max_bytes: int | None = None,
+        ttl_seconds: float = float("inf"),
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key):
+        """
+        Return the value cached under `key`, or None.
+        """
+        if key is None:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None and (
+                time.monotonic() - entry[0] > self.ttl_seconds
+            ):
+                self._remove(key)
+                entry = None
+
+            if entry is None:
+                self._misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        size = _value_bytes(value)
+        max_bytes = float("inf") if self.max_bytes is None else self.max_bytes
+        if key is None or self.max_entries <= 0 or size > max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (time.monotonic(), value, size)
+            self._bytes += size
+
+            # Drop the least recently used entries until both limits hold
+            while (
+                len(self._entries) > self.max_entries
+                or self._bytes > max_bytes
+            ):
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                # JSON has no infinity, entries without a TTL report None
+                "ttl_seconds": (
+                    self.ttl_seconds
+                    if self.ttl_seconds < float("inf")
+                    else None
+                ),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / max(lookups, 1), 4),
+                "evictions": self._evictions,
+            }
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
@@ -0,0 +1,445 @@
+import json
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+import numpy as np
+import requests
+import shapely
+from scipy.spatial import cKDTree
+
+from API.CNN import (
+    build_reference_coordinates,
+    build_reference_matrix,
+    find_top_matches,
+    rerank_top_matches,
+)
+from API.ann_index import ANN_MIN_ROWS, load_ann_index
+from API.embedding import EmbeddingHead
+from API.quantization import (
+    QUANTIZED_RERANK_K,
+    load_codec,
+    quantized_candidates,
+)
+
+# Bump when the layout of the store changes in an incompatible way
+FEATURE_STORE_FORMAT_VERSION = 1
+
+MANIFEST_FILE = "manifest.json"
+FEATURES_FILE = "features.npy"
+EMBEDDING_FILE = "embedding.npz"
+INDEX_FILE = "index.npz"
+CODEC_FILE = "codec.npz"
+CODES_FILE = "codes.npy"
+
+
+class FeatureStore:
+    """
+    Reference database of the image matcher.
+
+    `features` is a float32 matrix with one L2-normalized feature vector per
+    reference image. When loaded with mmap it is backed by the store file,
+    so every worker process shares the same pages through the OS cache.
+    `image_names` and `coordinates` are aligned with its rows. With an
+    `embedding_head` the rows are compact descriptors and query features
+    go through the same head before they are compared. With an `index`
+    searches go through the approximate nearest-neighbour index instead of
+    comparing the query with every row. With a `codec` the rows are first
+    scored against their compact `codes` and only the best candidates are
+    re-ranked with `features`, so few pages of the float32 matrix have to
+    stay in memory. A KD-tree over `coordinates` limits searches to the
+    reference views near a known position.
+    """
+
+    def __init__(
+        self,
+        image_names,
+        features,
+        coordinates,
+        manifest=None,
+        embedding_head=None,
+        index=None,
+        codec=None,
+        codes=None,
+    ):
+        self.image_names = list(image_names)
+        self.features = features
+        self.coordinates = np.asarray(coordinates, dtype=np.float64)
+        self.manifest = manifest or {}
+        self.embedding_head = embedding_head
+        self.index = index
+        self.codec = codec
+        self.codes = codes
+        self._spatial_index = None
+
+    def embed(self, query_features):
+        """
+        Map raw VGG16 query features into the space of the stored rows.
+        """
+        if self.embedding_head is None:
+            return query_features
+        return self.embedding_head.apply(query_features)
+
+    @property
+    def spatial_index(self) -> cKDTree:
+        # Built on first use, views without SLAM coordinates sit at 0, 0
+        if self._spatial_index is None:
+            self._spatial_index = cKDTree(self.coordinates)
+        return self._spatial_index
+
+    def rows_within(self, point, radius: float):
+        """
+        Returns the sorted rows of the reference views within `radius` of
+        an (x, y) point in EPSG:28992.
+        """
+        rows = self.spatial_index.query_ball_point(point, radius)
+        return np.sort(np.asarray(rows, dtype=np.int64))
+
+    def rows_inside(self, polygon):
+        """
+        Returns the sorted rows of the reference views inside a shapely
+        polygon in EPSG:28992.
+        """
+        # Only test the views within the circle around the polygon bounds
+        min_x, min_y, max_x, max_y = polygon.bounds
+        rows = self.rows_within(
+            ((min_x + max_x) / 2, (min_y + max_y) / 2),
+            np.hypot(max_x - min_x, max_y - min_y) / 2,
+        )
+        inside = shapely.contains_xy(
+            polygon, self.coordinates[rows, 0], self.coordinates[rows, 1]
+        )
+        return rows[inside]
+
+    def search(
+        self,
+        query_features,
+        top_n_matches: int,
+        exact=False,
+        candidate_rows=None,
+    ):
+        """
+        Returns the row indices and cosine distances of the top N reference
+        images for every raw query feature vector. Without an index or
+        codec, or with `exact`, every reference row is compared. With
+        `candidate_rows` only those rows are compared.
+        """
+        query_features = self.embed(query_features)
+
+        if candidate_rows is not None:
+            # A location prior already narrowed the search to a few views
+            candidates = [candidate_rows] * len(np.atleast_2d(query_features))
+        elif exact or (self.index is None and self.codec is None):
+            return find_top_matches(
+                query_features, self.features, top_n_matches
+            )
+        elif self.codec is None:
+            return self.index.search(query_features, top_n_matches)
+        elif self.index is not None:
+            # Restrict the quantized search to the probed lists of the index
+            candidates = self.index.probe(
+                query_features, min_rows=top_n_matches
+            )
+        else:
+            candidates = None
+
+        if self.codec is not None and not exact:
+            candidates = quantized_candidates(
+                query_features,
+                self.codec,
+                self.codes,
+                max(QUANTIZED_RERANK_K, top_n_matches),
+                candidates,
+            )
+
+        return rerank_top_matches(
+            query_features, self.features, candidates, top_n_matches
+        )
+
+    @property
+    def build_id(self) -> str | None:
+        return self.manifest.get("build_id")
+
+    def __len__(self):
+        return len(self.image_names)
+
+
+def feature_store_exists(store_dir: str) -> bool:
+    return os.path.exists(os.path.join(store_dir, MANIFEST_FILE))
+
+
+def save_feature_store(
+    store_dir: str,
+    image_names,
+    features,
+    coordinates,
+    extra=None,
+    embedding_head=None,
+    ann_index=None,
+    codec=None,
+):
+    """
+    Write a feature store to `store_dir`.
+
+    The feature matrix is normalized and written as float32 `.npy`, the
+    image names and coordinates go into a JSON manifest. The manifest is
+    written last, so a store without one is incomplete. `extra` adds
+    entries to the manifest. `features` have to be the output of
+    `embedding_head` when one is given, `ann_index` has to be built on
+    the normalized `features` and `codec` fitted on them. The codes of
+    the codec are written next to the full features, which are still
+    needed to re-rank the candidates.
+    """
+    features = build_reference_matrix(features)
+    coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+
+    if not len(image_names) == len(features) == len(coordinates):
+        raise ValueError(
+            "Image names, features and coordinates must have the same length."
+        )
+
+    os.makedirs(store_dir, exist_ok=True)
+
+    # Write to temporary files first so readers never see a partial store
+    features_path = os.path.join(store_dir, FEATURES_FILE)
+    np.save(features_path + ".tmp.npy", features)
+    os.replace(features_path + ".tmp.npy", features_path)
+
+    # Data files next to the manifest, listed so the store can be copied
+    files = [FEATURES_FILE]
+
+    embedding = {"head": "raw"}
+    if embedding_head is not None:
+        embedding_head.save(os.path.join(store_dir, EMBEDDING_FILE))
+        embedding = {"head": embedding_head.name, "file": EMBEDDING_FILE}
+        files.append(EMBEDDING_FILE)
+
+    index = {"kind": "exact"}
+    if ann_index is not None:
+        ann_index.save(os.path.join(store_dir, INDEX_FILE))
+        index = {**ann_index.stats(), "file": INDEX_FILE}
+        files.append(INDEX_FILE)
+
+    quantization = {"kind": "none"}
+    if codec is not None:
+        codes_path = os.path.join(store_dir, CODES_FILE)
+        np.save(codes_path + ".tmp.npy", codec.encode(features))
+        os.replace(codes_path + ".tmp.npy", codes_path)
+        codec.save(os.path.join(store_dir, CODEC_FILE))
+        quantization = {
+            **codec.stats(),
+            "file": CODEC_FILE,
+            "codes": CODES_FILE,
+        }
+        files.extend([CODEC_FILE, CODES_FILE])
+
+    manifest = {
+        "format_version": FEATURE_STORE_FORMAT_VERSION,
+        "build_id": uuid.uuid4().hex,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "count": len(features),
+        "dim": int(features.shape[1]) if len(features) else 0,
+        "dtype": "float32",
+        "normalized": True,
+        "embedding": embedding,
+        "index": index,
+        "quantization": quantization,
+        "files": files,
+        "images": [os.path.basename(name) for name in image_names],
+        "coordinates": coordinates.tolist(),
+        **(extra or {}),
+    }
+
+    manifest_path = os.path.join(store_dir, MANIFEST_FILE)
+    with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+    print(f"Feature store with {len(features)} images saved to {store_dir}")
+    return manifest
+
+
+def load_feature_store(
+    store_dir: str,
+    mmap: bool = True,
+    use_index: bool = True,
+    use_codec: bool = True,
+) -> FeatureStore:
+    """
+    Load a feature store, memory-mapping the feature matrix read-only.
+    With `use_index=False` or `use_codec=False` the stored ANN index or
+    quantized codes are ignored. Stores with fewer than ANN_MIN_ROWS rows
+    never use their index.
+    """
+    manifest_path = os.path.join(store_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        raise FileNotFoundError(
+            f"Feature store manifest '{manifest_path}' not found."
+        )
+
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+
+    if manifest.get("format_version") != FEATURE_STORE_FORMAT_VERSION:
+        raise ValueError(
+            f"Unsupported feature store format version "
+            f"{manifest.get('format_version')}, expected "
+            f"{FEATURE_STORE_FORMAT_VERSION}."
+        )
+
+    features = np.load(
+        os.path.join(store_dir, FEATURES_FILE),
+        mmap_mode="r" if mmap else None,
+    )
+
+    if features.shape[0] != manifest["count"]:
+        raise ValueError(
+            f"Feature store '{store_dir}' has {features.shape[0]} feature "
+            f"rows but {manifest['count']} images in its manifest."
+        )
+
+    embedding = manifest.get("embedding", {})
+    embedding_head = None
+    if "file" in embedding:
+        embedding_head = EmbeddingHead.load(
+            os.path.join(store_dir, embedding["file"])
+        )
+
+    index = manifest.get("index", {})
+    ann_index = None
+    if use_index and "file" in index and len(features) >= ANN_MIN_ROWS:
+        ann_index = load_ann_index(
+            os.path.join(store_dir, index["file"]), features
+        )
+
+    quantization = manifest.get("quantization", {})
+    codec, codes = None, None
+    if use_codec and "file" in quantization:
+        codec = load_codec(os.path.join(store_dir, quantization["file"]))
+        codes = np.load(
+            os.path.join(store_dir, quantization["codes"]),
+            mmap_mode="r" if mmap else None,
+        )
+
+    return FeatureStore(
+        manifest["images"],
+        features,
+        manifest["coordinates"],
+        manifest,
+        embedding_head,
+        ann_index,
+        codec,
+        codes,
+    )
+
+
+def embed_feature_store(store: FeatureStore, embedding_head: EmbeddingHead):
+    """
+    Return an in-memory copy of a raw feature store with its rows mapped
+    through `embedding_head`. The copy has no ANN index or codec.
+    """
+    if store.embedding_head is not None:
+        raise ValueError("Only raw feature stores can be embedded again.")
+
+    return FeatureStore(
+        store.image_names,
+        build_reference_matrix(embedding_head.apply(store.features)),
+        store.coordinates,
+        {
+            **store.manifest,
+            "embedding": {"head": embedding_head.name},
+            "index": {"kind": "exact"},
+            "quantization": {"kind": "none"},
+        },
+        embedding_head,
+    )
+
+
+def feature_store_from_pickle(pickle_data: bytes, csv_path: str):
+    """
+    Build an in-memory feature store from the content of a legacy
+    model.pkl holding (ref_image_paths, ref_vgg16_features).
+    """
+    ref_image_paths, ref_vgg16_features = pickle.loads(pickle_data)
+    ref_image_paths = [os.path.basename(path) for path in ref_image_paths]
+
+    return FeatureStore(
+        ref_image_paths,
+        build_reference_matrix(ref_vgg16_features),
+        build_reference_coordinates(ref_image_paths, csv_path),
+        {"format_version": FEATURE_STORE_FORMAT_VERSION, "source": "pickle"},
+    )
+
+
+def convert_pickle_to_store(pickle_path: str, csv_path: str, store_dir: str):
+    """
+    Migrate a legacy model.pkl into the feature store format.
+    """
+    with open(pickle_path, "rb") as f:
+        store = feature_store_from_pickle(f.read(), csv_path)
+
+    return save_feature_store(
+        store_dir, store.image_names, store.features, store.coordinates
+    )
+
+
+# Download one file of a published store into a directory
+def _download_file(base_url: str, filename: str, download_dir: str):
+    url = f"{base_url.rstrip('/')}/{filename}"
+    print(f"downloading {url}")
+
+    with requests.get(url, stream=True) as response:
+        response.raise_for_status()
+        with open(os.path.join(download_dir, filename), "wb") as f:
+            for chunk in response.iter_content(chunk_size=1 << 20):
+                f.write(chunk)
+
+
+def download_feature_store(base_url: str, store_dir: str):
+    """
+    Download the manifest and the data files of a store published under
+    `base_url` into `store_dir`, streaming them to disk.
+    """
+    download_dir = tempfile.mkdtemp(
+        dir=os.path.dirname(os.path.abspath(store_dir))
+    )
+
+    try:
+        _download_file(base_url, MANIFEST_FILE, download_dir)
+        with open(os.path.join(download_dir, MANIFEST_FILE)) as f:
+            filenames = json.load(f).get("files", [FEATURES_FILE])
+
+        for filename in filenames:
+            _download_file(base_url, filename, download_dir)
+
+        # Another worker may have finished the same download first
+        if feature_store_exists(store_dir):
+            return
+
+        # Move the manifest last, it marks the store as complete
+        os.makedirs(store_dir, exist_ok=True)
+        for filename in filenames + [MANIFEST_FILE]:
+            os.replace(
+                os.path.join(download_dir, filename),
+                os.path.join(store_dir, filename),
+            )
+
+    finally:
+        shutil.rmtree(download_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    # Convert an existing pickle, e.g.
+    # python -m API.feature_store API/data/model.pkl API/data/slam_coordinates.csv API/data/reference_store
+    if len(sys.argv) != 4:
+        print(
+            "usage: python -m API.feature_store "
+            "<model.pkl> <slam_coordinates.csv> <store_dir>"
+        )
+        sys.exit(1)
+
+    convert_pickle_to_store(*sys.argv[1:])
@@ -1,16 +1,25 @@
 import os
+from functools import lru_cache
 
+import numpy as np
 from pyproj import Transformer
-from shapely.geometry import Point
+import shapely
 import geopandas as gpd
 
 
 from API.CNN import match_query_images_and_get_center
+from API.feature_store import FeatureStore, feature_store_from_pickle
 
 # define standard CRS transformer 28992 -> 4326
 CRS28992_4326 = Transformer.from_crs(
     "EPSG:28992", "EPSG:4326", always_xy=True
 )
+CRS4326_28992 = Transformer.from_crs(
+    "EPSG:4326", "EPSG:28992", always_xy=True
+)
+
+# Default search radius in meters around a prior position
+PRIOR_RADIUS = float(os.getenv("PRIOR_RADIUS", 15))
 
 
 # Function to convert coordinates from EPSG:28992 to WGS84 using Transformer
@@ -29,6 +38,75 @@ def convert_coordinates(coordinates, transformer=CRS28992_4326):
         )  # Use (x, y) order for EPSG:28992 to EPSG:4326
 
 
+class RoomIndex:
+    """
+    Floorplan rooms in EPSG:28992 held in an STRtree of prepared polygons.
+
+    Lookups only test the polygons whose bounding boxes contain the point.
+    When polygons overlap, the room that comes first in the GeoJSON file is
+    returned.
+    """
+
+    def __init__(self, geojson_file_path: str):
+        # Read GeoJSON file into GeoDataFrame and transform to Dutch coordinate system (EPSG:28992)
+        gdf = gpd.read_file(geojson_file_path)
+        gdf = gdf.to_crs("EPSG:28992")
+
+        self.rooms = gdf["room"].tolist()
+        self.room_ids = {
+            room: i for i, room in reversed(list(enumerate(self.rooms)))
+        }
+        self.geometries = gdf.geometry.values.to_numpy()
+        shapely.prepare(self.geometries)
+        self.tree = shapely.STRtree(self.geometries)
+
+    def polygon(self, room: str):
+        """
+        Returns the polygon of `room`, or None for unknown rooms.
+        """
+        room_id = self.room_ids.get(room)
+        return None if room_id is None else self.geometries[room_id]
+
+    def lookup(self, point: tuple[float, float]) -> str:
+        return self.lookup_many([point])[0]
+
+    def lookup_many(self, points) -> list:
+        """
+        Returns the room containing each (x, y) point, or an empty string
+        for points outside every room.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        point_indices, room_indices = self.tree.query(
+            shapely.points(points), predicate="within"
+        )
+
+        # Keep the first room in file order for every point
+        first_room = np.full(len(points), len(self.rooms))
+        np.minimum.at(first_room, point_indices, room_indices)
+
+        return [
+            self.rooms[i] if i < len(self.rooms) else "" for i in first_room
+        ]
+
+
+# Room indexes are cached per file and rebuilt when the file is modified
+@lru_cache(maxsize=8)
+def _load_room_index(geojson_file_path: str, modified_time: float):
+    print(f"building room index:\t\t{os.path.basename(geojson_file_path)}")
+    return RoomIndex(geojson_file_path)
+
+
+def load_room_index(geojson_file_path: str) -> RoomIndex:
+    if not os.path.exists(geojson_file_path):
+        raise FileNotFoundError(
+            f"GeoJSON file '{geojson_file_path}' not found."
+        )
+
+    return _load_room_index(
+        geojson_file_path, os.path.getmtime(geojson_file_path)
+    )
+
+
 def point_in_polygon(point: tuple[float, float], geojson_file_path: str):
 
     x, y = point
@@ -36,40 +114,67 @@ def point_in_polygon(point: tuple[float, float], geojson_file_path: str):
     if not isinstance(x, (int, float)) or not isinstance(y, (int, float)):
         raise ValueError("Coordinates x and y must be numeric.")
 
-    if not os.path.exists(geojson_file_path):
-        raise FileNotFoundError(
-            f"GeoJSON file '{geojson_file_path}' not found."
-        )
+    # The point is not inside any polygon --> so empty string for dataframes
+    return load_room_index(geojson_file_path).lookup((x, y))
 
-    # Read GeoJSON file into GeoDataFrame and transform to Dutch coordinate system (EPSG:28992)
-    gdf = gpd.read_file(geojson_file_path)
-    gdf = gdf.to_crs("EPSG:28992")
 
-    # Create point geometry
-    point = Point(x, y)
+def points_in_polygons(points, geojson_file_path: str) -> list:
+    """
+    Resolves the rooms of many (x, y) points in EPSG:28992 in one call.
+    """
+    return load_room_index(geojson_file_path).lookup_many(points)
 
-    # Find polygon containing point
-    contains_point = gdf.contains(point)
-    if contains_point.any():
-        return gdf.loc[contains_point, "room"].iloc[0]
 
-    return ""  # The point is not inside any polygon --> so empty string for dataframes
+def get_prior_rows(
+    reference_store: FeatureStore,
+    floorplan_json_path: str,
+    prior_lnglat: tuple[float, float] | None = None,
+    prior_radius: float = PRIOR_RADIUS,
+    prior_room: str | None = None,
+    top_n_matches: int = 6,
+):
+    """
+    Returns the rows of the reference views near a coarse prior, either
+    within `prior_radius` meters of a (longitude, latitude) position or
+    inside the polygon of `prior_room`.
+
+    Returns None without a prior, or when too few views are near it to
+    fill the top N matches, so the whole building is searched.
+    """
+    if prior_room is not None:
+        polygon = load_room_index(floorplan_json_path).polygon(prior_room)
+        if polygon is None:
+            raise ValueError(f"Unknown prior room '{prior_room}'.")
+        rows = reference_store.rows_inside(polygon)
+
+    elif prior_lnglat is not None:
+        point = CRS4326_28992.transform(*prior_lnglat)
+        rows = reference_store.rows_within(point, prior_radius)
+
+    else:
+        return None
+
+    print(f"reference views near prior:\t{len(rows)}")
+    if len(rows) < top_n_matches:
+        print("too few views near the prior, searching all of them")
+        return None
+
+    return rows
 
 
 def get_room_name(
     img_names: str | list,
     floorplan_json_path: str,
-    ref_vgg16_features: list,
-    ref_image_paths: list,
-    slam_csv_path: str,
+    reference_store: FeatureStore,
     top_n_matches: int = 6,
     min_DBSCAN_samples: int = 3,
+    candidate_rows=None,
 ) -> tuple[str, tuple[float, float]]:
 
     print(f"retrieving coordinates for {len(img_names)} user images")
     print("-" * 30)
 
-    print("ref image paths:", ref_image_paths)
+    print("reference images:", len(reference_store))
 
     if isinstance(img_names, str):
         # needs to be in list else matching breaks
@@ -77,22 +182,20 @@ def get_room_name(
 
         center_coords = match_query_images_and_get_center(
             img_names,
-            ref_vgg16_features,
-            ref_image_paths,
-            slam_csv_path,
+            reference_store,
             top_n_matches=top_n_matches,
             min_DBSCAN_samples=1,
+            candidate_rows=candidate_rows,
         )
 
     elif isinstance(img_names, list):
 
         center_coords = match_query_images_and_get_center(
             img_names,
-            ref_vgg16_features,
-            ref_image_paths,
-            slam_csv_path,
+            reference_store,
             top_n_matches=top_n_matches,
             min_DBSCAN_samples=min_DBSCAN_samples,
+            candidate_rows=candidate_rows,
         )
 
     else:
@@ -194,7 +297,8 @@ if __name__ == "__main__":
     trained_model_path: str = get_file_paths(data_path, extension="pkl")
     slam_csv_path: str = get_file_paths(data_path, extension="csv")
 
-    room_name = get_room_name(
-        img_names, floorplan_json_path, trained_model_path, slam_csv_path
-    )
+    with open(trained_model_path, "rb") as f:
+        reference_store = feature_store_from_pickle(f.read(), slam_csv_path)
+
+    room_name = get_room_name(img_names, floorplan_json_path, reference_store)
     print(room_name)
@@ -1,17 +1,39 @@
-import json
+import io
 import os
-import pickle
 import shutil
 import subprocess
+import tempfile
 from typing import List
 
-from fastapi import FastAPI, File, HTTPException, Request, UploadFile
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import FastAPI, File, Form, HTTPException, Request, UploadFile
+from fastapi.responses import HTMLResponse, JSONResponse, Response
+import networkx as nx
+from pydantic import BaseModel
 import requests
 
 # Importing custom functions
-from API.get_room_name import get_file_paths, get_room_name
-from API.routing import navigation
+from API.CNN import (
+    match_cache,
+    query_feature_cache,
+    vgg16_batcher,
+    warm_up_vgg16_model,
+)
+from API.feature_store import (
+    download_feature_store,
+    feature_store_exists,
+    feature_store_from_pickle,
+    load_feature_store,
+)
+from API.get_room_name import PRIOR_RADIUS, get_prior_rows, get_room_name
+from API.model_registry import model_registry
+from API.routing import (
+    RESTRICTED_ROOMS,
+    cached_route,
+    get_routing_engine,
+    navigation_many,
+    route_from_coordinate,
+)
+from API.worker_pool import BoundedWorkerPool, PoolSaturatedError
 from functions_framework import http
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -47,23 +69,116 @@ async def add_security_headers(request: Request, call_next):
     return response
 
 
-# Ensure the user_data_cache folder exists
-cache_dir = os.path.join(API_FOLDER_PATH, "user_data_cache")
-os.makedirs(cache_dir, exist_ok=True)
+# Localization and routing run in bounded worker pools off the event loop
+WORKER_POOL_KIND = os.getenv("WORKER_POOL_KIND", "thread")
+localize_pool = BoundedWorkerPool(
+    "localize",
+    max_workers=int(os.getenv("LOCALIZE_WORKERS", 2)),
+    max_queue_size=int(os.getenv("LOCALIZE_QUEUE_SIZE", 8)),
+    kind=WORKER_POOL_KIND,
+    retry_after=int(os.getenv("LOCALIZE_RETRY_AFTER", 5)),
+)
+navigate_pool = BoundedWorkerPool(
+    "navigate",
+    max_workers=int(os.getenv("NAVIGATE_WORKERS", 4)),
+    max_queue_size=int(os.getenv("NAVIGATE_QUEUE_SIZE", 64)),
+    kind=WORKER_POOL_KIND,
+    retry_after=int(os.getenv("NAVIGATE_RETRY_AFTER", 1)),
+)
+
+
+@app.exception_handler(PoolSaturatedError)
+async def pool_saturated_handler(request: Request, exc: PoolSaturatedError):
+    return JSONResponse(
+        content={"error": str(exc)},
+        status_code=503,
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
+@app.on_event("shutdown")
+def shutdown_worker_pools():
+    localize_pool.shutdown()
+    navigate_pool.shutdown()
+
 
-if os.getenv("ENVIRONMENT") == "production":
+# Uploads larger than this are spooled to a temporary file instead of memory
+UPLOAD_SPOOL_THRESHOLD = int(
+    os.getenv("UPLOAD_SPOOL_THRESHOLD", 16 * 1024 * 1024)
+)
+# Spool large uploads to tmpfs when available so they stay off the disk
+UPLOAD_SPOOL_DIR = os.getenv(
+    "UPLOAD_SPOOL_DIR", "/dev/shm" if os.path.isdir("/dev/shm") else None
+)
+
+# Reference feature store, memory-mapped so all workers share its pages
+reference_store_path = os.getenv(
+    "REFERENCE_STORE_PATH", os.path.join(data_path, "reference_store")
+)
+slam_csv_path = os.path.join(data_path, "slam_coordinates.csv")
+
+if os.getenv("REFERENCE_STORE_URL") and not feature_store_exists(
+    reference_store_path
+):
+    download_feature_store(
+        os.getenv("REFERENCE_STORE_URL"), reference_store_path
+    )
+
+if feature_store_exists(reference_store_path):
+    print("reference store:", reference_store_path)
+    # ANN_INDEX=false and QUANTIZED_SEARCH=false fall back to exact search
+    # over all reference rows
+    reference_store = load_feature_store(
+        reference_store_path,
+        use_index=os.getenv("ANN_INDEX", "true").lower() != "false",
+        use_codec=os.getenv("QUANTIZED_SEARCH", "true").lower() != "false",
+    )
+elif os.getenv("ENVIRONMENT") == "production":
     reference_data_file = os.getenv(
         "REFERENCE_DATA_URL"
     )  # Get from external server URL
     if not reference_data_file:
-        raise ValueError("REFERENCE_DATA_URL is not set")
+        raise ValueError(
+            "REFERENCE_STORE_URL or REFERENCE_DATA_URL is not set"
+        )
     response = requests.get(reference_data_file)
-    ref_image_paths, ref_vgg16_features = pickle.loads(response.content)
+    reference_store = feature_store_from_pickle(
+        response.content, slam_csv_path
+    )
 else:
     reference_data_file = os.path.join(data_path, "model.pkl")
     print("reference data file:", reference_data_file)
     with open(reference_data_file, "rb") as f:
-        ref_image_paths, ref_vgg16_features = pickle.load(f)
+        reference_store = feature_store_from_pickle(f.read(), slam_csv_path)
+
+print(
+    "reference feature matrix shape:",
+    reference_store.features.shape,
+    "embedding:",
+    reference_store.manifest.get("embedding", {}).get("head", "raw"),
+    "index:",
+    reference_store.index.kind if reference_store.index else "exact",
+    "codec:",
+    reference_store.codec.kind if reference_store.codec else "none",
+)
+
+# Build the KD-tree over the reference view positions for location priors
+reference_store.spatial_index
+
+# Node files of the routing graph, one per floor or building
+nodes_json_paths = tuple(
+    os.path.join(data_path, name.strip())
+    for name in os.getenv("ROUTING_NODE_FILES", "nodes.geojson").split(",")
+)
+
+# Build the routing graph once at startup, it reloads when the files change
+get_routing_engine(
+    nodes_json_paths, os.path.join(data_path, "floorplan.geojson")
+)
+
+# Load the VGG16 model at startup unless it should be loaded on first use
+if os.getenv("MODEL_WARMUP", "true").lower() == "true":
+    warm_up_vgg16_model()
 
 
 @app.get("/")
@@ -97,22 +212,55 @@ async def main():
     return HTMLResponse(content=content)
 
 
-@app.post("/localize")
-async def upload_images(files: List[UploadFile] = File(...)):
+def localize_images(images, candidate_rows=None):
+    """
+    Calculates the room and coordinates of the user from the query images,
+    only matching the reference views in `candidate_rows` when given.
+    Runs in the localization worker pool.
     """
-    Handles image uploads, saves them to a directory, and calculates the user position based on the images.
+    floorplan_json_path = os.path.join(data_path, "floorplan.geojson")
+    # trained_model_path: str = os.path.join(data_path, "model.pkl")
 
-    Parameters:
-    -----------
-    files : List[UploadFile]
-        A list of uploaded files (images).
+    return get_room_name(
+        images,
+        floorplan_json_path,
+        reference_store,
+        candidate_rows=candidate_rows,
+    )
 
-    Returns:
-    --------
-    JSONResponse
-        A JSON-formatted response containing the user room and user coordinates.
+
+async def read_upload(file: UploadFile):
+    """
+    Returns the content of an uploaded image as a named in-memory buffer, or
+    as a temporary file in UPLOAD_SPOOL_DIR when it is very large.
+    Process pools need picklable arguments, so they always get buffers.
     """
-    # Process each uploaded file
+    if (
+        WORKER_POOL_KIND == "thread"
+        and file.size is not None
+        and file.size > UPLOAD_SPOOL_THRESHOLD
+    ):
+        spooled_file = tempfile.SpooledTemporaryFile(
+            max_size=UPLOAD_SPOOL_THRESHOLD, dir=UPLOAD_SPOOL_DIR
+        )
+        await file.seek(0)
+        shutil.copyfileobj(file.file, spooled_file)
+        spooled_file.seek(0)
+        return spooled_file
+
+    buffer = io.BytesIO(await file.read())
+    buffer.name = file.filename
+    return buffer
+
+
+async def localize_uploads(
+    files, prior_lng, prior_lat, prior_radius, prior_room
+):
+    """
+    Checks the uploaded images and location prior of a request and returns
+    the user room and coordinate computed in the localization worker pool.
+    """
+    # Check every uploaded file before reading any of them
     for file in files:
         # Get the file extension and ensure it's an allowed image type
         file_extension = os.path.splitext(file.filename)[1].lower()
@@ -123,30 +271,39 @@ async def upload_images(files: List[UploadFile] = File(...)):
                 detail=f"File type {file_extension} not supported. Only PNG and JPG are allowed.",
             )
 
-        # Define the path where the image will be saved
-        image_path = os.path.join(cache_dir, file.filename)
+    if (prior_lng is None) != (prior_lat is None):
+        raise HTTPException(
+            status_code=400,
+            detail="prior_lng and prior_lat must be given together.",
+        )
+    if prior_radius <= 0:
+        raise HTTPException(
+            status_code=400, detail="prior_radius must be positive."
+        )
 
-        # Save the uploaded image to the cache_dir folder
-        with open(image_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+    # Limit the search to the reference views near the prior, if any
+    try:
+        candidate_rows = get_prior_rows(
+            reference_store,
+            os.path.join(data_path, "floorplan.geojson"),
+            prior_lnglat=(
+                (prior_lng, prior_lat) if prior_lng is not None else None
+            ),
+            prior_radius=prior_radius,
+            prior_room=prior_room,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-    # After saving all images, run the coordinate calculation using the uploaded images
+    # Keep the images of this request in memory, they are never shared
+    images = [await read_upload(file) for file in files]
 
     try:
         print(f"Calculating user position from uploaded images.")
         print("=" * 80)
 
-        img_names: list = get_file_paths(cache_dir, images=True)
-        floorplan_json_path = os.path.join(data_path, "floorplan.geojson")
-        # trained_model_path: str = os.path.join(data_path, "model.pkl")
-        slam_csv_path: str = os.path.join(data_path, "slam_coordinates.csv")
-
-        user_room, user_coordinate = get_room_name(
-            img_names,
-            floorplan_json_path,
-            ref_vgg16_features,
-            ref_image_paths,
-            slam_csv_path,
+        user_room, user_coordinate = await localize_pool.run(
+            localize_images, images, candidate_rows
         )
         print("=" * 80)
 
@@ -157,18 +314,45 @@ async def upload_images(files: List[UploadFile] = File(...)):
         )
 
     finally:
-        # Clean up by deleting all files in the cache_dir directory
-        print("-" * 30)
-        print(f"removing user images")
+        # Release the image buffers and spooled files of this request
+        for image in images:
+            image.close()
 
-        for file in os.listdir(cache_dir):
-            file_path = os.path.join(cache_dir, file)
+    return user_room, user_coordinate
 
-            try:
-                os.remove(file_path)
 
-            except Exception as e:
-                print(f"Failed to delete {file_path}: {e}")
+@app.post("/localize")
+async def upload_images(
+    files: List[UploadFile] = File(...),
+    prior_lng: float | None = Form(None),
+    prior_lat: float | None = Form(None),
+    prior_radius: float = Form(PRIOR_RADIUS),
+    prior_room: str | None = Form(None),
+):
+    """
+    Handles image uploads, reads them into memory, and calculates the user position based on the images.
+
+    Parameters:
+    -----------
+    files : List[UploadFile]
+        A list of uploaded files (images).
+    prior_lng, prior_lat : float, optional
+        A coarse position of the user, e.g. the previous /localize result.
+        Only reference views within `prior_radius` meters are matched.
+    prior_radius : float, optional
+        Search radius in meters around the prior position.
+    prior_room : str, optional
+        A room the user is known to be in, only its reference views are
+        matched. Takes precedence over the prior position.
+
+    Returns:
+    --------
+    JSONResponse
+        A JSON-formatted response containing the user room and user coordinates.
+    """
+    user_room, user_coordinate = await localize_uploads(
+        files, prior_lng, prior_lat, prior_radius, prior_room
+    )
 
     # Return the user coordinates as a JSON response
     print(f"Sending user position:\t\t{user_room}, {user_coordinate}")
@@ -178,13 +362,76 @@ async def upload_images(files: List[UploadFile] = File(...)):
     )
 
 
+@app.get("/metrics")
+async def metrics():
+    """
+    Reports load time and memory usage of the models held by the server,
+    the VGG16 micro-batch sizes, the hits and memory use of the query and
+    route caches, the reference search index, and the queue depth and wait
+    times of the worker pools.
+    """
+    return JSONResponse(
+        content={
+            "models": model_registry.stats(),
+            "vgg16_batching": (
+                vgg16_batcher.stats() if vgg16_batcher is not None else None
+            ),
+            "query_caches": {
+                "features": query_feature_cache.stats(),
+                "matches": match_cache.stats(),
+            },
+            "reference_index": (
+                reference_store.index.stats()
+                if reference_store.index is not None
+                else {"kind": "exact", "count": len(reference_store)}
+            ),
+            "reference_codec": (
+                reference_store.codec.stats()
+                if reference_store.codec is not None
+                else {"kind": "none"}
+            ),
+            "route_cache": get_routing_engine(
+                nodes_json_paths, os.path.join(data_path, "floorplan.geojson")
+            ).route_cache.stats(),
+            "worker_pools": {
+                "localize": localize_pool.stats(),
+                "navigate": navigate_pool.stats(),
+            },
+        }
+    )
+
+
+# Seconds browsers and CDNs may reuse a /navigate response
+ROUTE_CACHE_MAX_AGE = int(os.getenv("ROUTE_CACHE_MAX_AGE", 300))
+
+# Largest number of start and end pairs of one /navigate/batch request
+NAVIGATE_BATCH_MAX_ROUTES = int(
+    os.getenv("NAVIGATE_BATCH_MAX_ROUTES", 10_000)
+)
+
+
+# True if an If-None-Match header lists the ETag of the current response
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [
+        tag.strip().removeprefix("W/") for tag in if_none_match.split(",")
+    ]
+    return "*" in tags or etag in tags
+
+
 @app.get("/navigate")
-async def find_route(start_room_name: str, end_room_name: str):
+async def find_route(
+    request: Request, start_room_name: str, end_room_name: str
+):
+    """
+    Returns the fastest route between two rooms as a GeoJSON LineString.
+
+    Routes are cached on the server and sent with an ETag and a
+    Cache-Control header, a request with a matching If-None-Match header
+    gets an empty 304 response.
+    """
     floorplan_json_path = os.path.join(data_path, "floorplan.geojson")
-    nodes_json_path = os.path.join(data_path, "nodes.geojson")
-    route_json_path = os.path.join(
-        API_FOLDER_PATH, "user_data_cache", "route.geojson"
-    )
 
     try:
         print("=" * 60)
@@ -192,53 +439,161 @@ async def find_route(start_room_name: str, end_room_name: str):
         print("Start Room:\t", start_room_name)
         print("End Room:\t", end_room_name)
 
-        rooms_to_exclude = ["orange_hall"]
-
-        # Run navigation function to generate the GeoJSON file
-        navigation(
+        # Get the route as a GeoJSON feature, cached until the files change
+        route, etag = await navigate_pool.run(
+            cached_route,
             start_room_name,
             end_room_name,
             floorplan_json_path,
-            nodes_json_path,
-            route_json_path,
-            restricted_rooms=rooms_to_exclude,
+            nodes_json_paths,
+            restricted_rooms=RESTRICTED_ROOMS,
         )
 
+    except nx.NodeNotFound as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except subprocess.CalledProcessError as e:
         raise HTTPException(
             status_code=500, detail=f"Error running scripts: {str(e)}"
         )
 
+    if route is None:
+        return JSONResponse(
+            content={"error": "No path found."}, status_code=404
+        )
+
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={ROUTE_CACHE_MAX_AGE}",
+    }
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        print("Route unchanged, sending 304")
+        return Response(status_code=304, headers=headers)
+
+    print(f"Sending routing json")
+    return JSONResponse(content=route, headers=headers)
+
+
+class BatchRouteRequest(BaseModel):
+    start_room_names: List[str]
+    end_room_names: List[str]
+    include_routes: bool = False
+
+
+@app.post("/navigate/batch")
+async def find_routes(batch: BatchRouteRequest):
+    """
+    Returns the route lengths in meters from every start room to every end
+    room, e.g. from the current room to all points of interest, as an N x M
+    matrix. Entries are null when there is no route. Routes that have to
+    cross a restricted room are flagged in the `restricted` matrix, like
+    /navigate they are only returned when there is no other way. With
+    `include_routes` the GeoJSON LineStrings of the routes are returned
+    as well.
+    """
+    n_routes = len(batch.start_room_names) * len(batch.end_room_names)
+    if n_routes == 0:
+        raise HTTPException(
+            status_code=400, detail="No start or end rooms given."
+        )
+    if n_routes > NAVIGATE_BATCH_MAX_ROUTES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {NAVIGATE_BATCH_MAX_ROUTES} routes per request.",
+        )
+
+    print("=" * 60)
+    print(
+        f"Calculating {len(batch.start_room_names)} x "
+        f"{len(batch.end_room_names)} routes"
+    )
+
     try:
-        # Load GeoJSON data from the generated file and return it as JSON response
-        with open(route_json_path, "r") as file:
-            geojson_data = json.load(file)
+        # One shortest path search per start room
+        routes = await navigate_pool.run(
+            navigation_many,
+            batch.start_room_names,
+            batch.end_room_names,
+            os.path.join(data_path, "floorplan.geojson"),
+            nodes_json_paths,
+            restricted_rooms=RESTRICTED_ROOMS,
+            include_routes=batch.include_routes,
+        )
+    except nx.NodeNotFound as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return JSONResponse(content=routes)
+
+
+@app.post("/localize_and_route")
+async def localize_and_route(
+    files: List[UploadFile] = File(...),
+    end_room_name: str = Form(...),
+    prior_lng: float | None = Form(None),
+    prior_lat: float | None = Form(None),
+    prior_radius: float = Form(PRIOR_RADIUS),
+    prior_room: str | None = Form(None),
+    level: float | None = Form(None),
+):
+    """
+    Localizes the user from the uploaded images like /localize and returns
+    the route from that position to a room in the same response.
 
-        print(f"Sending routing json")
-        return JSONResponse(content=geojson_data)
+    Parameters:
+    -----------
+    files, prior_lng, prior_lat, prior_radius, prior_room
+        As for /localize.
+    end_room_name : str
+        The destination room.
+    level : float, optional
+        The level the user is on, the position is snapped to the closest
+        walkable edge of that level, or of any level when not given.
 
-    except FileNotFoundError:
+    Returns:
+    --------
+    JSONResponse
+        The user room and coordinates, the position snapped to the routing
+        graph, and the route from there as a GeoJSON LineString.
+    """
+    user_room, user_coordinate = await localize_uploads(
+        files, prior_lng, prior_lat, prior_radius, prior_room
+    )
+    position = {"user_room": user_room, "user_coordinate": user_coordinate}
+    if not user_room or None in user_coordinate:
         return JSONResponse(
-            content={"error": "GeoJSON file not found."}, status_code=404
+            content={**position, "error": "Position not found."},
+            status_code=404,
         )
-    except json.JSONDecodeError:
-        return JSONResponse(
-            content={"error": "Invalid GeoJSON format."}, status_code=400
+
+    print("=" * 60)
+    print(f"Calculating route from {user_coordinate} to {end_room_name}")
+
+    try:
+        route, snapped = await navigate_pool.run(
+            route_from_coordinate,
+            user_coordinate,
+            end_room_name,
+            os.path.join(data_path, "floorplan.geojson"),
+            nodes_json_paths,
+            restricted_rooms=RESTRICTED_ROOMS,
+            level=level,
         )
+    except (nx.NodeNotFound, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-    finally:
-        # Delete the GeoJSON file after the response has been sent
-        cache_path_name = os.path.join(
-            os.path.basename(os.path.dirname(route_json_path)),
-            os.path.basename(route_json_path),
+    if route is None:
+        return JSONResponse(
+            content={
+                **position,
+                "snapped": snapped,
+                "error": "No path found.",
+            },
+            status_code=404,
         )
 
-        if os.path.exists(route_json_path):
-            try:
-                os.remove(route_json_path)
-                print(f"Deleted temporary file: {cache_path_name}")
-            except Exception as e:
-                print(f"Failed to delete {cache_path_name}: {e}")
+    print("Sending user position and route")
+    return JSONResponse(
+        content={**position, "snapped": snapped, "route": route}
+    )
 
 
 @http
@@ -0,0 +1,106 @@
+import resource
+import threading
+import time
+
+
+# Peak resident memory of this process in bytes (ru_maxrss is KiB on Linux)
+def get_peak_memory_bytes() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class ModelRegistry:
+    """
+    Process-wide registry of models that are expensive to load.
+
+    Every model is registered with a loader function and is only built once,
+    either lazily on the first `get` call or eagerly through `warm_up`. The
+    registry keeps the load time and memory footprint of every model so they
+    can be reported by the API.
+    """
+
+    def __init__(self):
+        self._loaders = {}
+        self._models = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, loader):
+        """
+        Register a loader function returning the model object for `name`.
+        """
+        self._loaders[name] = loader
+
+    def get(self, name: str):
+        """
+        Return the model registered as `name`, loading it on first use.
+        """
+        model = self._models.get(name)
+        if model is not None:
+            return model
+
+        # Only one thread loads the weights, the others wait for the result
+        with self._lock:
+            if name not in self._models:
+                self._models[name] = self._load(name)
+
+        return self._models[name]
+
+    def warm_up(self, name: str, warm_up_fn=None):
+        """
+        Load the model `name` and optionally run `warm_up_fn(model)` once,
+        so the first request does not pay for lazy initialisation.
+        """
+        model = self.get(name)
+
+        if warm_up_fn is not None:
+            start_time = time.perf_counter()
+            warm_up_fn(model)
+            self._stats[name]["warm_up_seconds"] = round(
+                time.perf_counter() - start_time, 4
+            )
+
+        return model
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._models
+
+    def stats(self) -> dict:
+        """
+        Return load statistics of every registered model.
+        """
+        return {
+            name: dict(self._stats.get(name, {"loaded": False}))
+            for name in self._loaders
+        }
+
+    def _load(self, name: str):
+        if name not in self._loaders:
+            raise KeyError(f"No model registered under the name '{name}'.")
+
+        print(f"loading model:\t\t\t{name}")
+        memory_before = get_peak_memory_bytes()
+        start_time = time.perf_counter()
+
+        model = self._loaders[name]()
+
+        load_seconds = time.perf_counter() - start_time
+        stats = {
+            "loaded": True,
+            "load_seconds": round(load_seconds, 4),
+            "peak_memory_increase_bytes": get_peak_memory_bytes()
+            - memory_before,
+        }
+
+        # Report the size of the weights for torch modules
+        if hasattr(model, "parameters"):
+            stats["parameter_bytes"] = sum(
+                p.numel() * p.element_size() for p in model.parameters()
+            )
+
+        self._stats[name] = stats
+        print(f"model '{name}' loaded in {load_seconds:.2f}s:\t{stats}")
+        return model
+
+
+# Shared registry used by the API modules
+model_registry = ModelRegistry()
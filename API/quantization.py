@@ -0,0 +1,240 @@
+import os
+
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+
+from API.CNN import normalize_features
+
+# Candidates of the quantized search that are re-ranked with the exact
+# features, per query
+QUANTIZED_RERANK_K = int(os.getenv("QUANTIZED_RERANK_K", 32))
+
+# Rows decoded or scored at once, bounds the float32 copies of the codes
+QUANTIZED_CHUNK = 8192
+
+# Rows used to fit the product quantizer codebooks of large stores
+PQ_TRAINING_SAMPLE = 50_000
+
+
+class ScalarQuantizer:
+    """
+    8-bit scalar quantization, one byte per dimension.
+
+    Every dimension is mapped linearly from its range over the reference
+    rows to 0..255, a quarter of the float32 size. Queries stay float32
+    and are scored against the decoded codes (asymmetric distance).
+    """
+
+    kind = "sq8"
+
+    def __init__(self, offset, scale):
+        self.offset = offset
+        self.scale = scale
+
+    def encode(self, features):
+        codes = np.empty(features.shape, dtype=np.uint8)
+        for start in range(0, len(features), QUANTIZED_CHUNK):
+            chunk = np.asarray(features[start : start + QUANTIZED_CHUNK])
+            codes[start : start + QUANTIZED_CHUNK] = np.clip(
+                np.rint((chunk - self.offset) / self.scale), 0, 255
+            )
+        return codes
+
+    def similarities(self, queries, codes):
+        """
+        Returns the approximate dot products of normalized `queries` with
+        the rows encoded in `codes`.
+        """
+        # q . (offset + scale * code) = q . offset + (q * scale) . code
+        scaled_queries = queries * self.scale
+        similarities = np.empty((len(queries), len(codes)), dtype=np.float32)
+        for start in range(0, len(codes), QUANTIZED_CHUNK):
+            chunk = codes[start : start + QUANTIZED_CHUNK].astype(np.float32)
+            similarities[:, start : start + QUANTIZED_CHUNK] = (
+                scaled_queries @ chunk.T
+            )
+        return similarities + (queries @ self.offset)[:, np.newaxis]
+
+    def stats(self) -> dict:
+        return {"kind": self.kind, "bytes_per_row": len(self.offset)}
+
+    def save(self, path: str):
+        np.savez(
+            path,
+            kind=np.array(self.kind),
+            offset=self.offset,
+            scale=self.scale,
+        )
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path) as arrays:
+            return cls(arrays["offset"], arrays["scale"])
+
+
+class ProductQuantizer:
+    """
+    Product quantization with 256 centroids per subspace.
+
+    The dimensions are split into `n_subspaces` equal blocks and every
+    block of a reference row is replaced by the byte id of its closest
+    centroid. A query is scored with one lookup table of block dot
+    products per subspace (asymmetric distance).
+    """
+
+    kind = "pq"
+
+    def __init__(self, codebooks):
+        # Shape (n_subspaces, 256, subspace_dim)
+        self.codebooks = codebooks
+
+    @property
+    def n_subspaces(self) -> int:
+        return len(self.codebooks)
+
+    def _split(self, features):
+        features = np.asarray(features, dtype=np.float32)
+        return features.reshape(len(features), self.n_subspaces, -1)
+
+    def encode(self, features):
+        codes = np.empty((len(features), self.n_subspaces), dtype=np.uint8)
+        for start in range(0, len(features), QUANTIZED_CHUNK):
+            blocks = self._split(features[start : start + QUANTIZED_CHUNK])
+            for subspace, codebook in enumerate(self.codebooks):
+                # Closest centroid by squared euclidean distance
+                distances = (
+                    np.sum(codebook**2, axis=1)
+                    - 2 * blocks[:, subspace] @ codebook.T
+                )
+                codes[start : start + len(blocks), subspace] = np.argmin(
+                    distances, axis=1
+                )
+        return codes
+
+    def similarities(self, queries, codes):
+        """
+        Returns the approximate dot products of normalized `queries` with
+        the rows encoded in `codes`.
+        """
+        # tables[q, s, c] = dot product of block s of query q and centroid c
+        tables = np.einsum(
+            "qsd,scd->qsc", self._split(queries), self.codebooks
+        )
+        subspaces = np.arange(self.n_subspaces)
+
+        similarities = np.empty((len(queries), len(codes)), dtype=np.float32)
+        for start in range(0, len(codes), QUANTIZED_CHUNK):
+            chunk = np.asarray(codes[start : start + QUANTIZED_CHUNK])
+            for query_index, table in enumerate(tables):
+                similarities[query_index, start : start + len(chunk)] = table[
+                    subspaces, chunk
+                ].sum(axis=1)
+        return similarities
+
+    def stats(self) -> dict:
+        return {"kind": self.kind, "bytes_per_row": self.n_subspaces}
+
+    def save(self, path: str):
+        np.savez(path, kind=np.array(self.kind), codebooks=self.codebooks)
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path) as arrays:
+            return cls(arrays["codebooks"])
+
+
+# Codec classes by the kind stored in their file
+CODEC_TYPES = {
+    ScalarQuantizer.kind: ScalarQuantizer,
+    ProductQuantizer.kind: ProductQuantizer,
+}
+
+
+def load_codec(path: str):
+    with np.load(path) as arrays:
+        kind = str(arrays["kind"])
+
+    if kind not in CODEC_TYPES:
+        raise ValueError(
+            f"Unsupported codec '{kind}'. "
+            f"Only {', '.join(CODEC_TYPES)} are supported."
+        )
+    return CODEC_TYPES[kind].load(path)
+
+
+def fit_codec(kind: str, features, n_subspaces: int = 64):
+    """
+    Fit the codec `kind` ("sq8" or "pq") on the normalized reference rows.
+    """
+    if kind == ScalarQuantizer.kind:
+        offset = np.min(features, axis=0).astype(np.float32)
+        scale = (np.max(features, axis=0) - offset) / 255
+        # Constant dimensions decode to their offset
+        return ScalarQuantizer(
+            offset, np.maximum(scale, np.finfo(np.float32).tiny)
+        )
+
+    if kind != ProductQuantizer.kind:
+        raise ValueError(
+            f"Unsupported codec '{kind}'. "
+            f"Only {', '.join(CODEC_TYPES)} are supported."
+        )
+
+    n_refs, dim = features.shape
+    if dim % n_subspaces:
+        raise ValueError(
+            f"{dim} dimensions cannot be split into {n_subspaces} subspaces."
+        )
+
+    sample = features
+    if n_refs > PQ_TRAINING_SAMPLE:
+        rng = np.random.default_rng(0)
+        sample = features[
+            np.sort(rng.choice(n_refs, PQ_TRAINING_SAMPLE, replace=False))
+        ]
+    sample = np.asarray(sample, dtype=np.float32).reshape(
+        len(sample), n_subspaces, -1
+    )
+
+    # With fewer rows than centroids the unused entries repeat the first one
+    n_centroids = min(256, len(sample))
+    codebooks = np.zeros(
+        (n_subspaces, 256, dim // n_subspaces), dtype=np.float32
+    )
+    for subspace in range(n_subspaces):
+        kmeans = MiniBatchKMeans(
+            n_clusters=n_centroids, random_state=0, n_init=3
+        )
+        kmeans.fit(sample[:, subspace])
+        codebooks[subspace, :n_centroids] = kmeans.cluster_centers_
+        codebooks[subspace, n_centroids:] = kmeans.cluster_centers_[0]
+
+    print(f"fitted pq codec with {n_subspaces} subspaces")
+    return ProductQuantizer(codebooks)
+
+
+# Approximate top K rows of every query from the quantized codes
+def quantized_candidates(
+    query_features, codec, codes, rerank_k, candidates=None
+):
+    """
+    Scores the queries against `codes`, or only against the rows in
+    `candidates` (one array per query), and returns the `rerank_k` best
+    rows per query for an exact re-rank.
+    """
+    queries = normalize_features(np.atleast_2d(query_features))
+
+    if candidates is None:
+        similarities = codec.similarities(queries, codes)
+        rerank_k = min(rerank_k, len(codes))
+        return list(
+            np.argpartition(-similarities, rerank_k - 1, axis=1)[:, :rerank_k]
+        )
+
+    top_rows = []
+    for query, rows in zip(queries, candidates):
+        rows = np.sort(rows)
+        similarities = codec.similarities(query[np.newaxis], codes[rows])[0]
+        k = min(rerank_k, len(rows))
+        top_rows.append(rows[np.argpartition(-similarities, k - 1)[:k]])
+    return top_rows
@@ -1,59 +1,212 @@
+import hashlib
+import heapq
 import json
 import os
+import sys
+import threading
 from math import sqrt
-from shapely.geometry import shape, Point
+
 import networkx as nx
-import geopandas as gpd
+import numpy as np
+import shapely
+from pyproj import Transformer
+from scipy.spatial import cKDTree
+from shapely.geometry import shape
+
+from API.contraction import (
+    CONTRACTION_FILE,
+    RESTRICTED_EDGE_WEIGHT,
+    ContractionHierarchy,
+    build_contraction_hierarchy,
+)
+from API.feature_cache import FeatureCache
+
+# Number of computed routes kept per routing engine, 0 disables the cache
+ROUTE_CACHE_SIZE = int(os.getenv("ROUTE_CACHE_SIZE", 1024))
+
+# Customized contraction hierarchy metrics kept per routing engine, one per
+# set of restricted rooms
+CONTRACTION_METRIC_CACHE_SIZE = int(
+    os.getenv("CONTRACTION_METRIC_CACHE_SIZE", 8)
+)
+
+# Rooms routes avoid unless there is no other way
+RESTRICTED_ROOMS = ["orange_hall"]
+
+# Restricted room sets served from the precomputed route table
+ROUTE_TABLE_PROFILES = ((), tuple(RESTRICTED_ROOMS))
+
+# Route table file, stored next to nodes.geojson
+ROUTE_TABLE_FILE = "route_table.npz"
+
+# Largest route table (labels x nodes) built per profile, campus-scale
+# graphs are searched with A* instead
+ROUTE_TABLE_MAX_CELLS = int(os.getenv("ROUTE_TABLE_MAX_CELLS", 50_000_000))
 
+# Largest route table built while loading the graph when ROUTE_TABLE_FILE
+# is missing or outdated, bigger graphs need the offline build-table step
+# and are searched with A* until then
+ROUTE_TABLE_INLINE_MAX_CELLS = int(
+    os.getenv("ROUTE_TABLE_INLINE_MAX_CELLS", 250_000)
+)
 
-def build_graph(nodes_json_path):
+# Bump when the edge weights change, so older route tables are rebuilt
+ROUTE_TABLE_VERSION = 4
+
+# Nodes are stored in CRS84 lon/lat, distances are measured in EPSG:28992
+CRS84_28992 = Transformer.from_crs("EPSG:4326", "EPSG:28992", always_xy=True)
+
+
+# The node files of a routing graph as a tuple, from one path or several
+def node_files(nodes_json_paths) -> tuple:
+    if isinstance(nodes_json_paths, (str, os.PathLike)):
+        return (nodes_json_paths,)
+    return tuple(nodes_json_paths)
+
+
+# Walking distance in meters charged for a level transition on top of the
+# horizontal distance: a fixed cost plus a cost per level. Lifts connect
+# every pair of levels they stop at, stairs and ramps consecutive levels.
+TRANSITION_COSTS = {
+    "stairs": {"fixed": 0.0, "per_level": 12.0, "all_levels": False},
+    "ramp": {"fixed": 0.0, "per_level": 8.0, "all_levels": False},
+    "lift": {"fixed": 20.0, "per_level": 3.0, "all_levels": True},
+}
+
+
+def build_graph(nodes_json_paths):
     """
-    Build and return a graph G based on the data from the specified GeoJSON file.
-    Nodes and edges are added to the graph with Euclidean distances as edge weights.
+    Build and return a graph G based on the data from the specified GeoJSON
+    files, one per floor or building. Nodes keep their lon/lat `coordinates`
+    and get metric `xy` coordinates in EPSG:28992, edges are added with
+    Euclidean distances in meters as weights.
+
+    Every node has a `building` and a numeric `level`, read from its
+    properties or from the "building" and "level" members of its file.
+    Nodes with a "transition" property ("stairs", "lift" or "ramp") are
+    connected to the nodes with the same "connector" (their label by
+    default) on the other levels of their building, weighted by
+    TRANSITION_COSTS. Node ids have to be unique over all files.
     """
-    nodes = json.load(open(nodes_json_path, "r", encoding="utf-8"))
     G = nx.Graph()
+    # Nodes by label, the first node with a label is the one routed to
+    G.graph["label_index"] = {}
+    connectors = {}
+    neighbor_lists = []
 
-    # Add nodes to the graph
-    for feature in nodes["features"]:
-        node_id = feature["properties"]["id"]
-        label = feature["properties"]["label"]
-        coordinates = feature["geometry"]["coordinates"]
-        G.add_node(node_id, label=label, coordinates=coordinates)
-
-    # Add edges between nodes based on neighbors and calculate edge weights
-    for feature in nodes["features"]:
-        node_id = feature["properties"]["id"]
-        neighbors = feature["properties"]["neighbors"]
+    for nodes_json_path in node_files(nodes_json_paths):
+        with open(nodes_json_path, "r", encoding="utf-8") as f:
+            nodes = json.load(f)
+
+        # Project all node positions to meters in one call
+        lonlat = np.array(
+            [
+                feature["geometry"]["coordinates"][:2]
+                for feature in nodes["features"]
+            ]
+        ).reshape(-1, 2)
+        xs, ys = CRS84_28992.transform(lonlat[:, 0], lonlat[:, 1])
+
+        # Add nodes to the graph
+        for feature, x, y in zip(nodes["features"], xs, ys):
+            properties = feature["properties"]
+            node_id = properties["id"]
+            label = properties["label"]
+            coordinates = feature["geometry"]["coordinates"]
+            if G.has_node(node_id):
+                raise ValueError(
+                    f"Node id {node_id} of '{nodes_json_path}' is used twice."
+                )
+
+            building = properties.get("building", nodes.get("building"))
+            level = properties.get("level", nodes.get("level"))
+            G.add_node(
+                node_id,
+                label=label,
+                coordinates=coordinates,
+                xy=(float(x), float(y)),
+                building="" if building is None else str(building),
+                level=0 if level is None else level,
+            )
+            G.graph["label_index"].setdefault(label, node_id)
+
+            transition = properties.get("transition")
+            if transition:
+                if transition not in TRANSITION_COSTS:
+                    raise ValueError(
+                        f"Unsupported transition '{transition}' of node "
+                        f"{node_id}. Only {', '.join(TRANSITION_COSTS)} "
+                        "are supported."
+                    )
+                G.nodes[node_id]["transition"] = transition
+                connector = properties.get("connector") or label
+                connectors.setdefault(
+                    (G.nodes[node_id]["building"], connector), []
+                ).append(node_id)
+
+        neighbor_lists.extend(
+            (feature["properties"]["id"], feature["properties"]["neighbors"])
+            for feature in nodes["features"]
+        )
+
+    # Add edges between nodes based on neighbors and calculate edge weights,
+    # once all files are read as neighbors can be in other files
+    for node_id, neighbors in neighbor_lists:
         if neighbors:
             neighbors = [int(n.strip()) for n in neighbors.split(",")]
             for neighbor in neighbors:
                 if not G.has_edge(node_id, neighbor):
-                    coord1 = G.nodes[node_id]["coordinates"]
-                    coord2 = G.nodes[neighbor]["coordinates"]
-                    distance = sqrt(
-                        (coord1[0] - coord2[0]) ** 2
-                        + (coord1[1] - coord2[1]) ** 2
-                    )
+                    distance = heuristic(node_id, neighbor, G)
                     G.add_edge(node_id, neighbor, weight=distance)
 
+    # Connect the stairs, lifts and ramps across levels
+    for node_ids in connectors.values():
+        add_transition_edges(G, node_ids)
+
     return G
 
 
-# Heuristic function for A*
+def add_transition_edges(G, node_ids):
+    """
+    Connect the transition nodes `node_ids` of one connector between their
+    levels, with the cost model of the transition in TRANSITION_COSTS.
+    """
+    node_ids = sorted(node_ids, key=lambda node_id: G.nodes[node_id]["level"])
+
+    for i, u in enumerate(node_ids):
+        transition = G.nodes[u]["transition"]
+        costs = TRANSITION_COSTS[transition]
+        targets = (
+            node_ids[i + 1 :]
+            if costs["all_levels"]
+            else node_ids[i + 1 : i + 2]
+        )
+
+        for v in targets:
+            levels = abs(G.nodes[v]["level"] - G.nodes[u]["level"])
+            if levels == 0 or G.has_edge(u, v):
+                continue
+            G.add_edge(
+                u,
+                v,
+                weight=heuristic(u, v, G)
+                + costs["fixed"]
+                + costs["per_level"] * levels,
+                transition=transition,
+            )
+
+
+# Heuristic function for A*, the straight line distance in meters
 def heuristic(a, b, G):
-    coord_a = G.nodes[a]["coordinates"]
-    coord_b = G.nodes[b]["coordinates"]
+    coord_a = G.nodes[a]["xy"]
+    coord_b = G.nodes[b]["xy"]
     return sqrt(
         (coord_a[0] - coord_b[0]) ** 2 + (coord_a[1] - coord_b[1]) ** 2
     )
 
 
 def get_room_id(room_name: str, G):
-    for node_id, data in G.nodes(data=True):
-        if data["label"] == room_name:
-            return node_id
-    return None
+    return G.graph["label_index"].get(room_name)
 
 
 def path_to_linestring(path, G):
@@ -68,10 +221,16 @@ def path_to_linestring(path, G):
         coordinates.append([x, y])
 
     # Create a GeoJSON LineString from the coordinates
+    properties = {}
+    # Multi-floor routes also list the level of every vertex
+    levels = [G.nodes[node]["level"] for node in path]
+    if any(level != levels[0] for level in levels):
+        properties["levels"] = levels
+
     linestring_geojson = {
         "type": "Feature",
         "geometry": {"type": "LineString", "coordinates": coordinates},
-        "properties": {},
+        "properties": properties,
         "crs": {
             "type": "name",
             "properties": {"name": "urn:ogc:def:crs:EPSG::4326"},
@@ -80,90 +239,1032 @@ def path_to_linestring(path, G):
 
     return linestring_geojson
 
-# Helper function to update edge weights
-def update_edge_weights_for_restricted_rooms(G, floorplan, restricted_rooms, new_weight=float('inf')):
-    
-    # Filter to get only the polygons for restricted rooms using geopandas
-    floorplan_gdf = gpd.GeoDataFrame.from_features(floorplan["features"])
-    restricted_gdf = floorplan_gdf[floorplan_gdf['room'].isin(restricted_rooms)]
-
-    print('-' * 60)
-    print(f'Setting weights of edges within restricted rooms: {restricted_rooms}')
-    # Iterate over nodes and update weights of their connected edges if the node is within a restricted room
-    for node_id, node_data in G.nodes(data=True):
-        node_point = Point(node_data['coordinates'])  # Assuming 'pos' is (x, y) for each node
-        if any(restricted_poly.contains(node_point) for restricted_poly in restricted_gdf.geometry):
-            # Update weights of all edges connected to this node
-            
-            # print(f'\tFound node {node_id}')
-            for neighbor in G.neighbors(node_id):
-                G[node_id][neighbor]['weight'] = new_weight
-                # print(f'\t\tRaise edge weight with node {neighbor} to {new_weight}')
 
+# Find the graph nodes that lie inside each room polygon of the floorplan,
+# on the level and in the building of the room when the polygon has them
+def get_nodes_in_rooms(G, floorplan):
+    node_ids = np.array(list(G.nodes))
+    node_coordinates = np.array(
+        [G.nodes[node_id]["coordinates"][:2] for node_id in node_ids]
+    ).reshape(-1, 2)
+    node_levels = np.array(
+        [G.nodes[node_id]["level"] for node_id in node_ids]
+    )
+    node_buildings = np.array(
+        [G.nodes[node_id]["building"] for node_id in node_ids]
+    )
 
-def navigation(
-    start: str,
-    end: str,
-    floorplan_json_path: str,
-    nodes_json_path: str,
-    route_output_path: str,
-    restricted_rooms: list = []
+    room_nodes = {}
+    for feature in floorplan["features"]:
+        room = feature["properties"].get("room")
+        if not feature.get("geometry") or room is None:
+            continue
+
+        # Test all nodes against the polygon in one call
+        polygon = shape(feature["geometry"])
+        inside = shapely.contains_xy(
+            polygon, node_coordinates[:, 0], node_coordinates[:, 1]
+        )
+        if feature["properties"].get("level") is not None:
+            inside &= node_levels == feature["properties"]["level"]
+        if feature["properties"].get("building") is not None:
+            inside &= node_buildings == str(feature["properties"]["building"])
+        room_nodes.setdefault(room, set()).update(
+            int(node_id) for node_id in node_ids[inside]
+        )
+
+    return {room: frozenset(nodes) for room, nodes in room_nodes.items()}
+
+
+# SHA-256 of the GeoJSON files a route table was built from
+def hash_routing_files(*paths) -> str:
+    digest = hashlib.sha256(str(ROUTE_TABLE_VERSION).encode("utf-8"))
+    for path in paths:
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+# Quoted ETag of a route response, a hash of its JSON content
+def route_etag(linestring) -> str:
+    content = json.dumps(linestring, sort_keys=True).encode("utf-8")
+    return f'"{hashlib.sha256(content).hexdigest()[:32]}"'
+
+
+# Edge weight overlay adding `penalty` to every edge touching a restricted
+# room
+def restricted_edge_weight(
+    room_nodes, restricted_rooms, penalty=RESTRICTED_EDGE_WEIGHT
+):
+    """
+    Returns a weight function for networkx that leaves the weights stored in
+    the graph untouched, so the graph can be shared between requests.
+    """
+    restricted_nodes = frozenset().union(
+        *(room_nodes.get(room, ()) for room in restricted_rooms)
+    )
+
+    def weight(u, v, data):
+        if u in restricted_nodes or v in restricted_nodes:
+            return data["weight"] + penalty
+        return data["weight"]
+
+    return weight
+
+
+class CSRGraph:
+    """
+    Routing graph as NumPy arrays for fast A* searches.
+
+    Node i has the id `node_ids[i]` and the EPSG:28992 position `xy[i]`.
+    Its neighbors are `indices[indptr[i]:indptr[i + 1]]` with the edge
+    lengths in meters at the same positions of `weights` (compressed
+    sparse row adjacency). Nodes on several floors have their level in
+    `node_level`, edges between levels include their transition cost, so
+    the straight line heuristic of A* stays admissible.
+    """
+
+    def __init__(self, G):
+        self.node_ids = np.array(list(G.nodes), dtype=np.int64)
+        self.node_index = {int(n): i for i, n in enumerate(self.node_ids)}
+        self.xy = np.array([G.nodes[n]["xy"] for n in G.nodes]).reshape(-1, 2)
+        self.label_index = {
+            label: self.node_index[node_id]
+            for label, node_id in G.graph["label_index"].items()
+        }
+
+        # Every undirected edge is stored in both directions, sorted by node
+        edges = np.array(
+            [
+                (self.node_index[u], self.node_index[v], data["weight"])
+                for u, v, data in G.edges(data=True)
+            ]
+        ).reshape(-1, 3)
+        self.edge_nodes = edges[:, :2].astype(np.int64)
+        self.edge_weights = edges[:, 2]
+        sources = np.concatenate([edges[:, 0], edges[:, 1]]).astype(np.int64)
+        targets = np.concatenate([edges[:, 1], edges[:, 0]]).astype(np.int64)
+        order = np.lexsort((targets, sources))
+
+        self.indptr = np.zeros(len(self.node_ids) + 1, dtype=np.int64)
+        self.indptr[1:] = np.cumsum(
+            np.bincount(sources, minlength=len(self.node_ids))
+        )
+        self.indices = targets[order]
+        self.weights = np.concatenate([edges[:, 2], edges[:, 2]])[order]
+
+        # Plain lists are faster than NumPy scalars in the search loop
+        self._indptr = self.indptr.tolist()
+        self._indices = self.indices.tolist()
+        self._weights = self.weights.tolist()
+        self._spatial_index = None
+
+        # Level of every node
+        self.node_level = np.array(
+            [G.nodes[n]["level"] for n in G.nodes], dtype=np.float64
+        )
+
+        # Longest edge within a level, bounds the search of `snap`
+        u, v = self.edge_nodes.T
+        same_level = self.node_level[u] == self.node_level[v]
+        self.max_edge_length = float(
+            np.hypot(*(self.xy[u] - self.xy[v])[same_level].T).max(initial=0)
+        )
+
+    @property
+    def spatial_index(self) -> cKDTree:
+        # KD-tree over the node positions, built on first use
+        if self._spatial_index is None:
+            self._spatial_index = cKDTree(self.xy)
+        return self._spatial_index
+
+    def snap(self, point, level=None):
+        """
+        Returns the walkable position closest to the EPSG:28992 `point`, on
+        `level` when given: the node indices u and v of the edge it lies
+        on, the fraction of the way from u to v and the distance to the
+        point in meters. Edges between levels are never snapped to, a node
+        without edges on its level is returned as (u, u, 0.0, distance).
+        """
+        point = np.asarray(point, dtype=np.float64)
+        n_nodes = len(self.node_ids)
+        on_level = np.ones(n_nodes, dtype=bool)
+        if level is not None:
+            on_level = self.node_level == level
+            if not on_level.any():
+                raise ValueError(f"No routing nodes on level {level}.")
+
+        # Closest node, widening the search until one is on the level
+        k = 1
+        while True:
+            distances, nodes = self.spatial_index.query(
+                point, k=min(k, n_nodes)
+            )
+            distances, nodes = np.atleast_1d(distances), np.atleast_1d(nodes)
+            found = on_level[nodes]
+            if found.any() or k >= n_nodes:
+                break
+            k *= 8
+        node, distance = int(nodes[found][0]), float(distances[found][0])
+
+        # An edge closer than that node has an end within this radius
+        candidates = np.asarray(
+            self.spatial_index.query_ball_point(
+                point, distance + self.max_edge_length / 2
+            ),
+            dtype=np.int64,
+        )
+        candidates = candidates[on_level[candidates]]
+
+        # All edges of the candidates, projected onto their segments at once
+        counts = self.indptr[candidates + 1] - self.indptr[candidates]
+        positions = np.repeat(self.indptr[candidates], counts) + (
+            np.arange(counts.sum())
+            - np.repeat(np.cumsum(counts) - counts, counts)
+        )
+        us = np.repeat(candidates, counts)
+        vs = self.indices[positions]
+        same_level = self.node_level[us] == self.node_level[vs]
+        us, vs = us[same_level], vs[same_level]
+        if len(us) == 0:
+            return node, node, 0.0, distance
+
+        starts = self.xy[us]
+        segments = self.xy[vs] - starts
+        lengths = np.maximum(np.sum(segments**2, axis=1), 1e-12)
+        fractions = np.clip(
+            np.sum((point - starts) * segments, axis=1) / lengths, 0, 1
+        )
+        offsets = starts + fractions[:, np.newaxis] * segments - point
+        edge_distances = np.hypot(offsets[:, 0], offsets[:, 1])
+
+        i = int(np.argmin(edge_distances))
+        return (
+            int(us[i]),
+            int(vs[i]),
+            float(fractions[i]),
+            float(edge_distances[i]),
+        )
+
+    def astar(self, source: int, target: int, blocked_nodes=frozenset()):
+        """
+        Returns the node ids of the shortest path between the node indices
+        `source` and `target`, or None if there is no path. Edges touching
+        a node index in `blocked_nodes` cost RESTRICTED_EDGE_WEIGHT more,
+        so paths through them are only returned when there is no other way.
+        """
+        # Straight line distance of every node to the target at once
+        h = np.hypot(*(self.xy - self.xy[target]).T).tolist()
+
+        indptr, indices, weights = self._indptr, self._indices, self._weights
+        n_nodes = len(h)
+        g = [float("inf")] * n_nodes
+        g[source] = 0.0
+        # -2 marks nodes that were never reached, -1 the source
+        parent = [-2] * n_nodes
+        parent[source] = -1
+        closed = bytearray(n_nodes)
+        counter = 0
+        queue = [(h[source], counter, source)]
+
+        while queue:
+            _, _, u = heapq.heappop(queue)
+            if u == target:
+                path = [u]
+                while parent[path[-1]] >= 0:
+                    path.append(parent[path[-1]])
+                return [int(self.node_ids[i]) for i in reversed(path)]
+
+            if closed[u]:
+                continue
+            closed[u] = 1
+
+            g_u = g[u]
+            u_blocked = u in blocked_nodes
+            for k in range(indptr[u], indptr[u + 1]):
+                v = indices[k]
+                if closed[v]:
+                    continue
+
+                cost = g_u + weights[k]
+                if u_blocked or v in blocked_nodes:
+                    cost += RESTRICTED_EDGE_WEIGHT
+
+                if cost < g[v]:
+                    g[v] = cost
+                    parent[v] = u
+                    counter += 1
+                    heapq.heappush(queue, (cost + h[v], counter, v))
+
+        return None
+
+    def dijkstra(self, source: int, blocked_nodes=frozenset(), targets=None):
+        """
+        Returns the path lengths from the node index `source` to every node
+        and the index of the previous node on each path (-1 for the source,
+        -2 for unreached nodes). Edges touching `blocked_nodes` are weighted
+        like in `astar`. The search stops once all node indices in
+        `targets` are settled.
+        """
+        indptr, indices, weights = self._indptr, self._indices, self._weights
+        n_nodes = len(self.node_ids)
+        g = [float("inf")] * n_nodes
+        g[source] = 0.0
+        parent = [-2] * n_nodes
+        parent[source] = -1
+        closed = bytearray(n_nodes)
+        remaining = set(targets) if targets is not None else None
+        counter = 0
+        queue = [(0.0, counter, source)]
+
+        while queue:
+            _, _, u = heapq.heappop(queue)
+            if closed[u]:
+                continue
+            closed[u] = 1
+
+            if remaining is not None:
+                remaining.discard(u)
+                if not remaining:
+                    break
+
+            g_u = g[u]
+            u_blocked = u in blocked_nodes
+            for k in range(indptr[u], indptr[u + 1]):
+                v = indices[k]
+                if closed[v]:
+                    continue
+
+                cost = g_u + weights[k]
+                if u_blocked or v in blocked_nodes:
+                    cost += RESTRICTED_EDGE_WEIGHT
+
+                if cost < g[v]:
+                    g[v] = cost
+                    parent[v] = u
+                    counter += 1
+                    heapq.heappush(queue, (cost, counter, v))
+
+        return g, parent
+
+    def tree_path(self, parent, target: int):
+        """
+        Returns the node ids of the path to the node index `target` in the
+        shortest path tree `parent` of `dijkstra`, or None if unreached.
+        """
+        if parent[target] == -2:
+            return None
+        path = [target]
+        while parent[path[-1]] >= 0:
+            path.append(parent[path[-1]])
+        return [int(self.node_ids[i]) for i in reversed(path)]
+
+
+class RouteTable:
+    """
+    Shortest paths between all labelled nodes for one set of restricted
+    rooms.
+
+    `label_nodes[i]` is the index in `node_ids` of the node labelled
+    `labels[i]`. Row i of `predecessors` holds the shortest path tree of
+    Dijkstra run from that node: the index of the previous node on the
+    path to every node, or -1. `distances[i, j]` is the path length from
+    `labels[i]` to `labels[j]`. A route is rebuilt by walking the
+    predecessors back from the end node, without any search.
+    """
+
+    def __init__(
+        self, labels, label_nodes, node_ids, predecessors, distances
+    ):
+        self.labels = list(labels)
+        self.label_nodes = label_nodes
+        self.node_ids = node_ids
+        self.predecessors = predecessors
+        self.distances = distances
+        self.label_index = {label: i for i, label in enumerate(self.labels)}
+
+    def find_path(self, start: str, end: str):
+        """
+        Returns the node ids of the shortest path from `start` to `end`,
+        None if there is no path, or raises KeyError for unknown labels.
+        """
+        source = self.label_index[start]
+        target = self.label_index[end]
+
+        # Unreachable nodes have no predecessor
+        if (
+            self.predecessors[source, self.label_nodes[target]] < 0
+            and source != target
+        ):
+            return None
+
+        path = [self.label_nodes[target]]
+        while self.predecessors[source, path[-1]] >= 0:
+            path.append(self.predecessors[source, path[-1]])
+        return [int(self.node_ids[i]) for i in reversed(path)]
+
+
+def build_route_table(G, room_nodes, restricted_rooms=()):
+    """
+    Run Dijkstra from every labelled node of G with the edges of the
+    restricted rooms weighted like in `RoutingEngine.find_path`.
+    """
+    node_ids = np.array(list(G.nodes), dtype=np.int64)
+    node_index = {int(n): i for i, n in enumerate(node_ids)}
+
+    # The first node with a label is the one get_room_id finds
+    labels = list(G.graph["label_index"])
+    sources = np.array(
+        [node_index[G.graph["label_index"][label]] for label in labels]
+    )
+
+    weight = (
+        restricted_edge_weight(room_nodes, restricted_rooms)
+        if restricted_rooms
+        else "weight"
+    )
+
+    dtype = np.int16 if len(node_ids) < 2**15 else np.int32
+    predecessors = np.full((len(labels), len(node_ids)), -1, dtype=dtype)
+    distances = np.full((len(labels), len(labels)), np.inf, dtype=np.float32)
+
+    for i, source in enumerate(sources):
+        lengths, paths = nx.single_source_dijkstra(
+            G, int(node_ids[source]), weight=weight
+        )
+        for node_id, path in paths.items():
+            if len(path) > 1:
+                predecessors[i, node_index[node_id]] = node_index[path[-2]]
+        for j, target in enumerate(sources):
+            distances[i, j] = lengths.get(int(node_ids[target]), np.inf)
+
+    return RouteTable(labels, sources, node_ids, predecessors, distances)
+
+
+# Route tables of every profile in ROUTE_TABLE_PROFILES, none for graphs
+# whose tables would hold more than `max_cells` predecessors
+def build_route_tables(
+    G,
+    room_nodes,
+    profiles=ROUTE_TABLE_PROFILES,
+    max_cells: int = ROUTE_TABLE_MAX_CELLS,
 ):
+    cells = len(G.graph["label_index"]) * len(G)
+    if cells > max_cells:
+        print(f"skipping route tables, {cells} cells exceed {max_cells}")
+        return {}
 
-    # Loading the floorplan containing the rooms
-    floorplan = json.load(open(floorplan_json_path, "r", encoding="utf-8"))
+    return {
+        frozenset(restricted_rooms): build_route_table(
+            G, room_nodes, restricted_rooms
+        )
+        for restricted_rooms in profiles
+    }
+
+
+def save_route_tables(path: str, tables: dict, source_hash: str):
+    """
+    Write the route tables of several restriction profiles to one .npz
+    file, tagged with the hash of the GeoJSON files they describe.
+    """
+    arrays = {"source_hash": np.array(source_hash)}
+    for i, (restricted_rooms, table) in enumerate(tables.items()):
+        arrays[f"restricted_{i}"] = np.array(
+            sorted(restricted_rooms), dtype=str
+        )
+        arrays[f"labels_{i}"] = np.array(table.labels, dtype=str)
+        arrays[f"label_nodes_{i}"] = table.label_nodes
+        arrays[f"node_ids_{i}"] = table.node_ids
+        arrays[f"predecessors_{i}"] = table.predecessors
+        arrays[f"distances_{i}"] = table.distances
+
+    np.savez_compressed(path + ".tmp.npz", **arrays)
+    os.replace(path + ".tmp.npz", path)
+    print(f"route tables for {len(tables)} profiles saved to {path}")
 
 
-    # build the graph using the nodes json
-    Graph = build_graph(nodes_json_path)
+def build_route_table_file(nodes_json_path, floorplan_json_path: str):
+    """
+    Offline build step writing the route tables of ROUTE_TABLE_PROFILES
+    to ROUTE_TABLE_FILE next to the (first) nodes file.
+    """
+    nodes_json_paths = node_files(nodes_json_path)
+    G = build_graph(nodes_json_paths)
+    with open(floorplan_json_path, "r", encoding="utf-8") as f:
+        room_nodes = get_nodes_in_rooms(G, json.load(f))
+
+    save_route_tables(
+        os.path.join(os.path.dirname(nodes_json_paths[0]), ROUTE_TABLE_FILE),
+        build_route_tables(G, room_nodes),
+        hash_routing_files(*nodes_json_paths, floorplan_json_path),
+    )
+
+
+def load_route_tables(path: str, source_hash: str):
+    """
+    Returns the route tables stored at `path` by frozenset of restricted
+    rooms, or None when the file is missing or built from other files.
+    """
+    if not os.path.exists(path):
+        return None
 
-    if restricted_rooms:
-        update_edge_weights_for_restricted_rooms(Graph, floorplan, restricted_rooms)
+    with np.load(path) as arrays:
+        if str(arrays["source_hash"]) != source_hash:
+            print(f"route table {path} is outdated, ignoring it")
+            return None
 
+        tables = {}
+        i = 0
+        while f"labels_{i}" in arrays:
+            table = RouteTable(
+                arrays[f"labels_{i}"].tolist(),
+                arrays[f"label_nodes_{i}"],
+                arrays[f"node_ids_{i}"],
+                arrays[f"predecessors_{i}"],
+                arrays[f"distances_{i}"],
+            )
+            tables[frozenset(arrays[f"restricted_{i}"].tolist())] = table
+            i += 1
 
-    start_node_id = get_room_id(start, Graph)
-    end_node_id = get_room_id(end, Graph)
+    return tables
+
+
+def build_contraction_file(nodes_json_path):
+    """
+    Offline build step writing the contraction hierarchy of the routing
+    graph to CONTRACTION_FILE next to the (first) nodes file. It only
+    depends on the nodes files, restricted rooms are applied per query.
+    """
+    nodes_json_paths = node_files(nodes_json_path)
+    csr_graph = CSRGraph(build_graph(nodes_json_paths))
+    # Split the graph by position and by level
+    hierarchy = build_contraction_hierarchy(
+        len(csr_graph.node_ids),
+        csr_graph.edge_nodes,
+        np.column_stack([csr_graph.xy, csr_graph.node_level]),
+    )
+    hierarchy.save(
+        os.path.join(os.path.dirname(nodes_json_paths[0]), CONTRACTION_FILE),
+        hash_routing_files(*nodes_json_paths),
+    )
+
+
+class RoutingEngine:
+    """
+    Routing graph built once from the nodes and floorplan GeoJSON files,
+    with one nodes file or one per floor or building.
+
+    The nodes inside every room are precomputed, so restricted rooms are
+    applied per query as blocked nodes of the A* search over a CSRGraph.
+    The files are only parsed again when their modification time changes.
+    Computed routes are kept in an LRU cache keyed by the file versions,
+    so a reload invalidates them.
+
+    Routes of the restriction profiles in ROUTE_TABLE_PROFILES come from
+    precomputed route tables, loaded from ROUTE_TABLE_FILE next to the
+    nodes file when it matches the GeoJSON files. Otherwise they are only
+    built for graphs within ROUTE_TABLE_INLINE_MAX_CELLS.
+    Other restrictions are searched in the contraction hierarchy stored in
+    CONTRACTION_FILE when there is one, with a metric customized once per
+    set of restricted rooms, and with A* otherwise.
+    """
+
+    def __init__(self, nodes_json_path, floorplan_json_path: str):
+        # One nodes file, or one per floor or building
+        self.nodes_json_paths = node_files(nodes_json_path)
+        self.floorplan_json_path = floorplan_json_path
+        self.route_table_path = os.path.join(
+            os.path.dirname(self.nodes_json_paths[0]), ROUTE_TABLE_FILE
+        )
+        self.contraction_path = os.path.join(
+            os.path.dirname(self.nodes_json_paths[0]), CONTRACTION_FILE
+        )
+        self._lock = threading.Lock()
+        self._state = None
+        self.route_cache = FeatureCache(ROUTE_CACHE_SIZE)
+        self.metric_cache = FeatureCache(CONTRACTION_METRIC_CACHE_SIZE)
+        self.reload_if_changed()
 
-    try:
-        path = nx.astar_path(
-            Graph,
-            start_node_id,
-            end_node_id,
-            heuristic=lambda a, b: heuristic(a, b, Graph),
-            weight="weight",
+    def _get_file_versions(self):
+        return tuple(
+            os.path.getmtime(path)
+            for path in (*self.nodes_json_paths, self.floorplan_json_path)
+        )
+
+    def reload_if_changed(self) -> bool:
+        """
+        Rebuild the graph if one of the GeoJSON files changed on disk.
+        """
+        file_versions = self._get_file_versions()
+        if self._state is not None and self._state[0] == file_versions:
+            return False
+
+        with self._lock:
+            if self._state is not None and self._state[0] == file_versions:
+                return False
+
+            print("-" * 60)
+            print("Building routing graph")
+            graph = build_graph(self.nodes_json_paths)
+            with open(self.floorplan_json_path, "r", encoding="utf-8") as f:
+                floorplan = json.load(f)
+            room_nodes = get_nodes_in_rooms(graph, floorplan)
+
+            route_tables = load_route_tables(
+                self.route_table_path,
+                hash_routing_files(
+                    *self.nodes_json_paths, self.floorplan_json_path
+                ),
+            )
+            if route_tables is None:
+                # Only small tables are built in the request path
+                print("Building route tables")
+                route_tables = build_route_tables(
+                    graph,
+                    room_nodes,
+                    max_cells=ROUTE_TABLE_INLINE_MAX_CELLS,
+                )
+
+            csr_graph = CSRGraph(graph)
+            hierarchy = ContractionHierarchy.load(
+                self.contraction_path,
+                hash_routing_files(*self.nodes_json_paths),
+            )
+            if hierarchy is not None and len(hierarchy.rank) != len(graph):
+                print("contraction hierarchy does not match the graph")
+                hierarchy = None
+
+            # Swap the whole state at once for requests running concurrently
+            self._state = (
+                file_versions,
+                graph,
+                room_nodes,
+                route_tables,
+                csr_graph,
+                hierarchy,
+            )
+            self.route_cache.clear()
+            self.metric_cache.clear()
+
+        return True
+
+    @property
+    def graph(self):
+        return self._state[1]
+
+    @property
+    def room_nodes(self):
+        return self._state[2]
+
+    @property
+    def route_tables(self):
+        return self._state[3]
+
+    @property
+    def csr_graph(self):
+        return self._state[4]
+
+    @property
+    def contraction_hierarchy(self):
+        return self._state[5]
+
+    def customized_metric(self, restricted_rooms=()):
+        """
+        Returns the contraction hierarchy arc weights and the edge weights
+        with RESTRICTED_EDGE_WEIGHT added to the edges of `restricted_rooms`,
+        customized once per set of rooms and file versions.
+        """
+        file_versions, _, room_nodes = self._state[:3]
+        csr_graph, hierarchy = self._state[4:6]
+        key = (file_versions, frozenset(restricted_rooms))
+
+        metric = self.metric_cache.get(key)
+        if metric is None:
+            blocked = np.zeros(len(csr_graph.node_ids), dtype=bool)
+            for room in restricted_rooms:
+                for node_id in room_nodes.get(room, ()):
+                    blocked[csr_graph.node_index[node_id]] = True
+
+            edge_weights = np.where(
+                blocked[csr_graph.edge_nodes].any(axis=1),
+                csr_graph.edge_weights + RESTRICTED_EDGE_WEIGHT,
+                csr_graph.edge_weights,
+            )
+            metric = (
+                hierarchy.customize(edge_weights).tolist(),
+                edge_weights.tolist(),
+            )
+            self.metric_cache.put(key, metric)
+
+        return metric
+
+    def find_path(self, start: str, end: str, restricted_rooms=()):
+        """
+        Returns the list of node ids of the shortest path between the nodes
+        labelled `start` and `end`, or None if there is no path.
+        """
+        self.reload_if_changed()
+        _, _, room_nodes, route_tables, csr_graph, hierarchy = self._state
+
+        # Precomputed profiles only need a walk through the table
+        table = route_tables.get(frozenset(restricted_rooms))
+        if (
+            table is not None
+            and start in table.label_index
+            and end in table.label_index
+        ):
+            return table.find_path(start, end)
+
+        for label in (start, end):
+            if label not in csr_graph.label_index:
+                raise nx.NodeNotFound(f"No node labelled {label} in G")
+
+        if hierarchy is not None:
+            weights, edge_weights = self.customized_metric(restricted_rooms)
+            path = hierarchy.find_path(
+                csr_graph.label_index[start],
+                csr_graph.label_index[end],
+                weights,
+                edge_weights,
+            )
+            if path is None:
+                return None
+            return [int(csr_graph.node_ids[i]) for i in path]
+
+        blocked_nodes = frozenset()
+        if restricted_rooms:
+            print("-" * 60)
+            print(
+                "Setting weights of edges within restricted rooms: "
+                f"{list(restricted_rooms)}"
+            )
+            blocked_nodes = frozenset(
+                csr_graph.node_index[node_id]
+                for room in restricted_rooms
+                for node_id in room_nodes.get(room, ())
+            )
+
+        return csr_graph.astar(
+            csr_graph.label_index[start],
+            csr_graph.label_index[end],
+            blocked_nodes,
+        )
+
+    def find_paths(self, start: str, ends, restricted_rooms=()):
+        """
+        Returns the path lengths in meters from the node labelled `start`
+        to the nodes labelled `ends` and the node ids of those paths, or
+        None for ends without a path. All paths come from one shortest
+        path tree, a row of a route table or a single Dijkstra search.
+        """
+        self.reload_if_changed()
+        _, _, room_nodes, route_tables, csr_graph, _ = self._state
+
+        for label in (start, *ends):
+            if label not in csr_graph.label_index:
+                raise nx.NodeNotFound(f"No node labelled {label} in G")
+
+        table = route_tables.get(frozenset(restricted_rooms))
+        if table is not None and all(
+            label in table.label_index for label in (start, *ends)
+        ):
+            source = table.label_index[start]
+            lengths = [
+                float(table.distances[source, table.label_index[end]])
+                for end in ends
+            ]
+            return lengths, [table.find_path(start, end) for end in ends]
+
+        blocked_nodes = frozenset(
+            csr_graph.node_index[node_id]
+            for room in restricted_rooms
+            for node_id in room_nodes.get(room, ())
+        )
+        targets = [csr_graph.label_index[end] for end in ends]
+        g, parent = csr_graph.dijkstra(
+            csr_graph.label_index[start], blocked_nodes, targets
+        )
+        return (
+            [g[target] for target in targets],
+            [csr_graph.tree_path(parent, target) for target in targets],
         )
 
-    except nx.NetworkXNoPath:
-        return None, "No path found."
+    def route_many(
+        self, start: str, ends, restricted_rooms=(), include_routes=False
+    ):
+        """
+        Returns the route lengths in meters, rounded to centimeters, from
+        `start` to every room in `ends`, None without a path, whether each
+        route has to cross a restricted room, and with `include_routes`
+        the routes as GeoJSON LineString features (None without a path).
+        Routes are only kept through a restricted room when there is no
+        other way, like `find_path` does.
+        """
+        lengths, paths = self.find_paths(start, ends, restricted_rooms)
+        graph = self.graph
 
-    linestring_str = path_to_linestring(path, Graph)
+        distances = []
+        restricted = []
+        for length, path in zip(lengths, paths):
+            # Restricted edges carry a penalty, measure the path instead
+            crossing = path is not None and length >= RESTRICTED_EDGE_WEIGHT
+            if crossing:
+                length = sum(
+                    graph.edges[u, v]["weight"]
+                    for u, v in zip(path, path[1:])
+                )
+            # Centimeters are plenty, the route tables store float32 lengths
+            distances.append(round(length, 2) if path is not None else None)
+            restricted.append(crossing)
+        if not include_routes:
+            return distances, restricted, None
 
-    # Save the GeoJSON to a file
-    with open(f"{route_output_path}", "w", encoding="utf-8") as f:
-        json.dump(linestring_str, f, ensure_ascii=False, indent=2)
+        routes = [
+            path_to_linestring(path, graph) if path is not None else None
+            for path in paths
+        ]
+        return distances, restricted, routes
 
-    folder_and_filename = os.path.join(
-        os.path.basename(os.path.dirname(route_output_path)),
-        os.path.basename(route_output_path),
+    def route_from_point(
+        self, lnglat, end: str, restricted_rooms=(), level=None
+    ):
+        """
+        Returns the route from the lon/lat position `lnglat`, snapped to the
+        closest walkable edge, to the room `end` as a GeoJSON LineString
+        feature starting at the snapped point, or None if there is no path,
+        and the snapped position with its distance to `lnglat` in meters.
+        """
+        self.reload_if_changed()
+        _, graph, room_nodes, _, csr_graph, _ = self._state
+
+        if end not in csr_graph.label_index:
+            raise nx.NodeNotFound(f"No node labelled {end} in G")
+
+        u, v, fraction, distance = csr_graph.snap(
+            CRS84_28992.transform(*lnglat), level
+        )
+        start_u = np.array(
+            graph.nodes[int(csr_graph.node_ids[u])]["coordinates"][:2]
+        )
+        start_v = np.array(
+            graph.nodes[int(csr_graph.node_ids[v])]["coordinates"][:2]
+        )
+        snapped = {
+            "coordinate": (start_u + fraction * (start_v - start_u)).tolist(),
+            "distance": round(distance, 2),
+            "edge": [int(csr_graph.node_ids[u]), int(csr_graph.node_ids[v])],
+        }
+
+        # One search from the destination reaches both ends of the edge
+        blocked_nodes = frozenset(
+            csr_graph.node_index[node_id]
+            for room in restricted_rooms
+            for node_id in room_nodes.get(room, ())
+        )
+        g, parent = csr_graph.dijkstra(
+            csr_graph.label_index[end], blocked_nodes, {u, v}
+        )
+
+        # Walk along the edge to the end closer to the destination
+        edge_length = float(np.hypot(*(csr_graph.xy[v] - csr_graph.xy[u])))
+        first = min(
+            (u, v),
+            key=lambda node: (
+                parent[node] == -2,
+                g[node]
+                + edge_length * (fraction if node == u else 1 - fraction),
+            ),
+        )
+        path = csr_graph.tree_path(parent, first)
+        if path is None:
+            return None, snapped
+
+        linestring = path_to_linestring(path[::-1], graph)
+        linestring["geometry"]["coordinates"].insert(0, snapped["coordinate"])
+        if "levels" in linestring["properties"]:
+            linestring["properties"]["levels"].insert(
+                0, graph.nodes[path[-1]]["level"]
+            )
+        return linestring, snapped
+
+    def route(self, start: str, end: str, restricted_rooms=()):
+        """
+        Returns the route between `start` and `end` as a GeoJSON LineString
+        feature with its ETag, or (None, None) if there is no path.
+        """
+        self.reload_if_changed()
+        file_versions, graph = self._state[:2]
+        key = (file_versions, start, end, frozenset(restricted_rooms))
+
+        cached = self.route_cache.get(key)
+        if cached is not None:
+            return cached
+
+        path = self.find_path(start, end, restricted_rooms)
+        if path is None:
+            print("No path found.")
+            result = (None, None)
+        else:
+            linestring = path_to_linestring(path, graph)
+            result = (linestring, route_etag(linestring))
+
+        self.route_cache.put(key, result)
+        return result
+
+
+# Routing engines are built once per pair of GeoJSON files
+_routing_engines = {}
+
+
+def get_routing_engine(nodes_json_path, floorplan_json_path: str):
+    key = (node_files(nodes_json_path), floorplan_json_path)
+    if key not in _routing_engines:
+        _routing_engines[key] = RoutingEngine(
+            nodes_json_path, floorplan_json_path
+        )
+    return _routing_engines[key]
+
+
+def cached_route(
+    start: str,
+    end: str,
+    floorplan_json_path: str,
+    nodes_json_path,
+    restricted_rooms=(),
+):
+    """
+    Returns the route between the rooms `start` and `end` as a GeoJSON
+    LineString feature and its ETag, or (None, None) if there is no path.
+    Routes are cached until one of the GeoJSON files changes.
+    """
+    # Get the routing graph, built once and reused between calls
+    engine = get_routing_engine(nodes_json_path, floorplan_json_path)
+    return engine.route(start, end, restricted_rooms)
+
+
+def route_from_coordinate(
+    lnglat,
+    end: str,
+    floorplan_json_path: str,
+    nodes_json_path,
+    restricted_rooms=(),
+    level=None,
+):
+    """
+    Returns the route from the lon/lat position `lnglat`, snapped to the
+    closest walkable edge on `level`, to the room `end` as a GeoJSON
+    LineString feature, or None if there is no path, and the snapped
+    position.
+    """
+    engine = get_routing_engine(nodes_json_path, floorplan_json_path)
+    return engine.route_from_point(lnglat, end, restricted_rooms, level)
+
+
+def navigation_many(
+    starts,
+    ends,
+    floorplan_json_path: str,
+    nodes_json_path,
+    restricted_rooms=(),
+    include_routes: bool = False,
+):
+    """
+    Returns the N x M matrix of route lengths in meters between the rooms
+    `starts` and `ends`, with one shortest path search per start, and the
+    matrix of whether each route has to cross a restricted room. Entries
+    are None when there is no path. With `include_routes` the N x M
+    GeoJSON LineString features of the routes are returned as well, None
+    without a path.
+    """
+    engine = get_routing_engine(nodes_json_path, floorplan_json_path)
+
+    # Repeated starts share their search
+    rows = {}
+    for start in starts:
+        if start not in rows:
+            rows[start] = engine.route_many(
+                start, ends, restricted_rooms, include_routes
+            )
+
+    result = {
+        "start_room_names": list(starts),
+        "end_room_names": list(ends),
+        "distances": [rows[start][0] for start in starts],
+        "restricted": [rows[start][1] for start in starts],
+    }
+    if include_routes:
+        result["routes"] = [rows[start][2] for start in starts]
+    return result
+
+
+def navigation(
+    start: str,
+    end: str,
+    floorplan_json_path: str,
+    nodes_json_path: str,
+    route_output_path: str | None = None,
+    restricted_rooms: list = [],
+):
+    """
+    Returns the route between the rooms `start` and `end` as a GeoJSON
+    LineString feature, or None if there is no path. The feature is also
+    written to `route_output_path` when one is given.
+    """
+    linestring, _ = cached_route(
+        start, end, floorplan_json_path, nodes_json_path, restricted_rooms
     )
+    if linestring is None:
+        return None
 
-    print(f"GeoJSON LineString saved to '{folder_and_filename}'.")
+    if route_output_path:
+        # Save the GeoJSON to a file
+        with open(f"{route_output_path}", "w", encoding="utf-8") as f:
+            json.dump(linestring, f, ensure_ascii=False, indent=2)
 
+        folder_and_filename = os.path.join(
+            os.path.basename(os.path.dirname(route_output_path)),
+            os.path.basename(route_output_path),
+        )
 
+        print(f"GeoJSON LineString saved to '{folder_and_filename}'.")
 
+    return linestring
 
 
 if __name__ == "__main__":
+    # python -m API.routing build-table writes API/data/route_table.npz
+    if sys.argv[1:] == ["build-table"]:
+        build_route_table_file(
+            os.path.join("API", "data", "nodes.geojson"),
+            os.path.join("API", "data", "floorplan.geojson"),
+        )
+        sys.exit(0)
+
+    # python -m API.routing build-contraction writes API/data/contraction.npz
+    if sys.argv[1:] == ["build-contraction"]:
+        build_contraction_file(os.path.join("API", "data", "nodes.geojson"))
+        sys.exit(0)
 
     # building_edge_path = os.path.join("data", "routing", "boundary.geojson")
     nodes_json_path = os.path.join("API", "data", "nodes.geojson")
     floorplan_json_path = os.path.join("API", "data", "floorplan.geojson")
-    route_output_path = os.path.join("API", "user_data_cache", "routing.geojson")
+    route_output_path = os.path.join(
+        "API", "user_data_cache", "routing.geojson"
+    )
 
     start = "geolab"
     end = "main_entrance"
 
-    #name of polygons that should be restricted while getting routing
+    # name of polygons that should be restricted while getting routing
     restricted_rooms = []
 
-    navigation(start, end, floorplan_json_path, nodes_json_path, route_output_path, restricted_rooms)
+    os.makedirs(os.path.dirname(route_output_path), exist_ok=True)
+
+    navigation(
+        start,
+        end,
+        floorplan_json_path,
+        nodes_json_path,
+        route_output_path,
+        restricted_rooms,
+    )
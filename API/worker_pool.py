@@ -0,0 +1,127 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+class PoolSaturatedError(Exception):
+    """
+    Raised when a job is submitted while all workers are busy and the queue
+    of waiting jobs is full.
+    """
+
+    def __init__(self, pool_name: str, retry_after: int):
+        super().__init__(f"The {pool_name} worker pool is at capacity.")
+        self.pool_name = pool_name
+        self.retry_after = retry_after
+
+
+# Runs in the worker, so it has to be a module level function for processes
+def _timed_call(submitted_at, fn, args, kwargs):
+    wait_seconds = time.time() - submitted_at
+    return wait_seconds, fn(*args, **kwargs)
+
+
+class BoundedWorkerPool:
+    """
+    Runs blocking functions off the asyncio event loop in a thread or
+    process pool.
+
+    At most `max_workers` jobs run at once and at most `max_queue_size`
+    jobs wait for a worker; further jobs are rejected with
+    PoolSaturatedError instead of piling up. With kind="process" the
+    function and its arguments have to be picklable.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_workers: int,
+        max_queue_size: int,
+        kind: str = "thread",
+        retry_after: int = 1,
+    ):
+        if kind == "thread":
+            self._executor = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix=name
+            )
+        elif kind == "process":
+            self._executor = ProcessPoolExecutor(max_workers=max_workers)
+        else:
+            raise ValueError(
+                f"Unsupported worker pool kind '{kind}'. "
+                "Only 'thread' and 'process' are supported."
+            )
+
+        self.name = name
+        self.kind = kind
+        self.max_workers = max_workers
+        self.max_queue_size = max_queue_size
+        self.retry_after = retry_after
+
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._completed = 0
+        self._rejected = 0
+        self._last_wait = 0.0
+        self._max_wait = 0.0
+        self._total_wait = 0.0
+
+    async def run(self, fn, *args, **kwargs):
+        """
+        Run `fn(*args, **kwargs)` in the pool and return its result.
+        """
+        with self._lock:
+            if self._in_flight >= self.max_workers + self.max_queue_size:
+                self._rejected += 1
+                raise PoolSaturatedError(self.name, self.retry_after)
+            self._in_flight += 1
+
+        try:
+            future = self._executor.submit(
+                _timed_call, time.time(), fn, args, kwargs
+            )
+        except BaseException:
+            with self._lock:
+                self._in_flight -= 1
+            raise
+
+        # The job keeps its slot until it finished in the executor, also
+        # when the awaiting request is cancelled before
+        future.add_done_callback(self._job_done)
+        _, result = await asyncio.wrap_future(future)
+        return result
+
+    def _job_done(self, future):
+        with self._lock:
+            self._in_flight -= 1
+            if future.cancelled() or future.exception() is not None:
+                return
+
+            wait_seconds, _ = future.result()
+            self._completed += 1
+            self._last_wait = wait_seconds
+            self._max_wait = max(self._max_wait, wait_seconds)
+            self._total_wait += wait_seconds
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "kind": self.kind,
+                "max_workers": self.max_workers,
+                "max_queue_size": self.max_queue_size,
+                "in_flight": self._in_flight,
+                "queue_depth": max(0, self._in_flight - self.max_workers),
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "wait_seconds": {
+                    "last": round(self._last_wait, 4),
+                    "mean": round(
+                        self._total_wait / max(self._completed, 1), 4
+                    ),
+                    "max": round(self._max_wait, 4),
+                },
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
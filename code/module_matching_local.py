@@ -1,4 +1,5 @@
 import os
+from functools import lru_cache
 import numpy as np
 import pickle
 from scipy.spatial.distance import cosine
@@ -26,25 +27,29 @@ def extract_vgg16_features(image_path, model, transform):
     features = features.flatten().numpy()  # Convert PyTorch tensor to numpy array and flatten
     return features
 
+# Load the SLAM coordinates CSV once into a {image name: (X, Y)} index
+@lru_cache(maxsize=None)
+def load_slam_coordinates(csv_path):
+    coordinates_df = pd.read_csv(csv_path).drop_duplicates('Image', keep='first')
+    return dict(zip(coordinates_df['Image'], zip(coordinates_df['X'], coordinates_df['Y'])))
+
 # Function to extract coordinates from CSV based on matching image name
 def extract_coordinates_from_match(ref_image_path, csv_path):
-    # Load the CSV file
-    coordinates_df = pd.read_csv(csv_path)
-
     # Extract the base part of the image name (remove _front, _left suffixes)
     base_name = os.path.basename(ref_image_path).split('_')[0] + '.jpg'
-    
-    # Find the corresponding image coordinates
-    row = coordinates_df[coordinates_df['Image'] == base_name]
-    
-    if row.empty:
+
+    # Find the corresponding image coordinates in the cached index
+    coordinates = load_slam_coordinates(csv_path).get(base_name)
+
+    if coordinates is None:
         print(f"Coordinates not found for image: {base_name}")
         return (0.0, 0.0)  # Return (0.0, 0.0) if coordinates are not found
-    
-    # Extract X, Y coordinates
-    x = row['X'].values[0]
-    y = row['Y'].values[0]
-    return (x, y)
+
+    return coordinates
+
+# Build the (X, Y) coordinates of every reference image, aligned with the feature rows
+def build_reference_coordinates(ref_image_paths, csv_path):
+    return np.array([extract_coordinates_from_match(path, csv_path) for path in ref_image_paths], dtype=np.float64)
 
 # Perform DBSCAN clustering and return the coordinates of the largest cluster's center
 def apply_dbscan_and_find_center(all_coords, eps=2, min_samples=3):
@@ -84,7 +89,12 @@ def match_query_images_and_get_center(query_image_paths, reference_data_file, cs
     ])
 
     all_coords = []  # To store all matched image coordinates
-    
+
+    # Load saved reference data and the coordinates of every reference image
+    with open(reference_data_file, 'rb') as f:
+        ref_image_paths, ref_vgg16_features = pickle.load(f)
+    ref_coordinates = build_reference_coordinates(ref_image_paths, csv_path)
+
     # Process each query image
     for query_image_path in query_image_paths:
         # print(f"Processing query image: {query_image_path}")
@@ -92,24 +102,19 @@ def match_query_images_and_get_center(query_image_paths, reference_data_file, cs
         # Extract VGG16 features for the query image
         query_features = extract_vgg16_features(query_image_path, model, transform)
 
-        # Load saved reference data
-        with open(reference_data_file, 'rb') as f:
-            ref_image_paths, ref_vgg16_features = pickle.load(f)
-
         # Compare query image with reference images' VGG16 feature vectors
         distances = []
         for i, ref_features in enumerate(ref_vgg16_features):
             distance = cosine(query_features, ref_features)
-            distances.append((distance, ref_image_paths[i]))
+            distances.append((distance, i))
 
         # Sort and get the top N matches
         distances.sort(key=lambda x: x[0])
         best_matches = distances[:top_n_matches]
 
-        # Extract coordinates for each matched image
-        for _, ref_image_path in best_matches:
-            coord = extract_coordinates_from_match(ref_image_path, csv_path)
-            all_coords.append(coord)
+        # Look up the coordinates of each matched image by its index
+        for _, ref_index in best_matches:
+            all_coords.append(tuple(ref_coordinates[ref_index]))
 
     # Perform DBSCAN clustering on all matched image coordinates and return the center of the largest cluster
     # print('-' * 20)
@@ -1,17 +1,14 @@
 import json
-from shapely.geometry import shape, Point
+from functools import lru_cache
+import numpy as np
+import shapely
+from shapely.geometry import shape
 import os
 import convertcoordinate as cc
 
-def point_in_polygon(point: tuple[float, float], geojson_file_path:str):
-    x, y = point
-    # Validate input types
-    if not isinstance(x, (int, float)) or not isinstance(y, (int, float)):
-        raise ValueError("Coordinates x and y must be numeric.")
-    
-    if not os.path.exists(geojson_file_path):
-        raise FileNotFoundError(f"GeoJSON file '{geojson_file_path}' not found.")
-    
+# Load the polygons of a GeoJSON file once into an STRtree of prepared geometries
+@lru_cache(maxsize=8)
+def load_polygon_index(geojson_file_path: str, modified_time: float):
     try:
         with open(geojson_file_path) as f:
             data = json.load(f)
@@ -22,22 +19,43 @@ def point_in_polygon(point: tuple[float, float], geojson_file_path:str):
     if 'features' not in data or not isinstance(data['features'], list):
         raise ValueError("GeoJSON file must contain a 'features' list.")
 
-    # Create a Shapely Point object for the input coordinates
-    point = Point(x, y)
-    
-    # Iterate over the features (polygons) in the GeoJSON file
+    rooms = []
+    geometries = []
     for feature in data['features']:
         if 'geometry' not in feature or not feature['geometry']:
             continue  # Skip invalid geometries
 
-        geometry = shape(feature['geometry'])
-        geometry = shape(feature['geometry'])
-        
-        # Check if the point is within the polygon
-        if geometry.contains(point):
-            return feature['properties'].get('room')  # Return polygon name
+        geometries.append(shape(feature['geometry']))
+        rooms.append(feature['properties'].get('room'))
+
+    geometries = np.array(geometries, dtype=object)
+    shapely.prepare(geometries)
+    return rooms, shapely.STRtree(geometries)
+
+def points_in_polygons(points, geojson_file_path: str) -> list:
+    if not os.path.exists(geojson_file_path):
+        raise FileNotFoundError(f"GeoJSON file '{geojson_file_path}' not found.")
+
+    rooms, tree = load_polygon_index(geojson_file_path, os.path.getmtime(geojson_file_path))
+
+    # Find the polygons containing each point with one tree query
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    point_indices, room_indices = tree.query(shapely.points(points), predicate='within')
+
+    # Return the first polygon in file order like the feature loop did
+    first_room = np.full(len(points), len(rooms))
+    np.minimum.at(first_room, point_indices, room_indices)
+
+    # The point is not inside any polygon --> so empty string for dataframes
+    return [rooms[i] if i < len(rooms) else '' for i in first_room]
+
+def point_in_polygon(point: tuple[float, float], geojson_file_path:str):
+    x, y = point
+    # Validate input types
+    if not isinstance(x, (int, float)) or not isinstance(y, (int, float)):
+        raise ValueError("Coordinates x and y must be numeric.")
 
-    return ''  # The point is not inside any polygon --> so empty string for dataframes
+    return points_in_polygons([(x, y)], geojson_file_path)[0]
 
 
 if __name__ == "__main__":
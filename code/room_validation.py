@@ -5,10 +5,10 @@ import convertcoordinate as cc
 from pyproj import Transformer
 from tqdm import tqdm
 
-from point_in_polygon import point_in_polygon
+from point_in_polygon import points_in_polygons
 from module_matching_local import match_query_images_and_get_center
 
-def get_room_name_and_time(img_names: str | list, floorplan_json_path: str, top_n_matches: int = 6, min_DBSCAN_samples: int = 3):
+def get_center_and_time(img_names: str | list, top_n_matches: int = 6, min_DBSCAN_samples: int = 3):
     start_time = time.time()
     # print('-' * 60)
     if isinstance(img_names, str):
@@ -23,12 +23,116 @@ def get_room_name_and_time(img_names: str | list, floorplan_json_path: str, top_
         raise TypeError
 
     center_coords = cc.convert_coordinates(center_coords)
-    room: str = point_in_polygon(center_coords, floorplan_json_path)
     # print(f'CRS conversion yields =\t{center_coords}')
-    # print(f'found room =\t\t\t{room}')
 
     calculation_time = time.time() - start_time
-    return room if room else '', calculation_time
+    return center_coords, calculation_time
+
+
+def add_found_rooms(df: pd.DataFrame, floorplan_json_path: str) -> pd.DataFrame:
+    # Resolve the rooms of all matched positions in one batch lookup
+    rooms = points_in_polygons(df['center_coords'].tolist(), floorplan_json_path)
+    df['found_room'] = [room if room else '' for room in rooms]
+    return df
+
+
+def load_raw_reference_store():
+    # Needs the API package on the path, e.g. PYTHONPATH=. python code/room_validation.py
+    from API.feature_store import feature_store_from_pickle
+
+    with open(reference_data_file, 'rb') as f:
+        return feature_store_from_pickle(f.read(), csv_path_coord)
+
+
+def extract_query_features(img_names: list):
+    from API.CNN import extract_vgg16_features_batch, get_vgg16_model
+
+    model, transform = get_vgg16_model()
+    return extract_vgg16_features_batch([os.path.join(user_image_folder, name) for name in img_names], model, transform)
+
+
+def compare_ann_search(df: pd.DataFrame, top_n_matches: int = 6, nprobes: tuple = (1, 2, 4, 8, 16)) -> pd.DataFrame:
+    from API.ann_index import build_ivf_index, recall_at_n
+    from API.CNN import rerank_top_matches
+    from API.quantization import QUANTIZED_RERANK_K, fit_codec, quantized_candidates
+
+    raw_store = load_raw_reference_store()
+    index = build_ivf_index(raw_store.features)
+    query_features = extract_query_features(df['user_image_name'].tolist())
+
+    start_time = time.time()
+    exact_indices, _ = raw_store.search(query_features, top_n_matches, exact=True)
+    results = [{'search': 'exact', 'recall_at_n': 1.0,
+                'search_ms_per_image': round((time.time() - start_time) / len(query_features) * 1000, 3)}]
+
+    # Recall@N of the inverted file index against the exact top N per probed list count
+    for nprobe in nprobes:
+        start_time = time.time()
+        ivf_indices, _ = index.search(query_features, top_n_matches, nprobe=nprobe)
+        results.append({'search': f'ivf nprobe={nprobe}/{index.nlist}',
+                        'recall_at_n': round(recall_at_n(exact_indices, ivf_indices), 4),
+                        'search_ms_per_image': round((time.time() - start_time) / len(query_features) * 1000, 3)})
+
+    # Recall@N of the quantized codes with an exact re-rank of their best candidates
+    for codec_kind in ['sq8', 'pq']:
+        codec = fit_codec(codec_kind, raw_store.features)
+        codes = codec.encode(raw_store.features)
+        start_time = time.time()
+        candidates = quantized_candidates(query_features, codec, codes, max(QUANTIZED_RERANK_K, top_n_matches))
+        codec_indices, _ = rerank_top_matches(query_features, raw_store.features, candidates, top_n_matches)
+        results.append({'search': f'{codec_kind} rerank={QUANTIZED_RERANK_K} ({codes.nbytes / 2**20:.1f} MB)',
+                        'recall_at_n': round(recall_at_n(exact_indices, codec_indices), 4),
+                        'search_ms_per_image': round((time.time() - start_time) / len(query_features) * 1000, 3)})
+
+    results = pd.DataFrame(results)
+    print("=" * 40)
+    print(f"Recall@{top_n_matches} on {len(query_features)} validation images")
+    print(results.to_string(index=False))
+    print("=" * 40)
+    return results
+
+
+def compare_embedding_heads(df: pd.DataFrame, floorplan_json_path: str, top_n_matches: int = 6, min_DBSCAN_samples: int = 3, n_components: int = 256) -> pd.DataFrame:
+    from API.CNN import apply_dbscan_and_find_center
+    from API.embedding import EMBEDDING_HEADS, fit_embedding_head
+    from API.feature_store import embed_feature_store
+
+    raw_store = load_raw_reference_store()
+
+    # Extract the query features once, every head starts from the same raw vectors
+    img_lists = [[name] if isinstance(name, str) else name for name in df['user_image_name']]
+    query_features = extract_query_features([name for names in img_lists for name in names])
+
+    results = []
+    for head_name in EMBEDDING_HEADS:
+        head = fit_embedding_head(head_name, raw_store.features, n_components)
+        store = raw_store if head_name == 'raw' else embed_feature_store(raw_store, head)
+
+        start_time = time.time()
+        indices, _ = store.search(query_features, top_n_matches)
+        search_time = (time.time() - start_time) / len(query_features)
+
+        centers, row = [], 0
+        for names in img_lists:
+            coords = store.coordinates[indices[row:row + len(names)]].reshape(-1, 2)
+            min_samples = 1 if len(names) == 1 else min_DBSCAN_samples
+            centers.append(cc.convert_coordinates(apply_dbscan_and_find_center(coords, min_samples=min_samples)))
+            row += len(names)
+
+        found_rooms = [room if room else '' for room in points_in_polygons(centers, floorplan_json_path)]
+        results.append({
+            'head': head_name,
+            'dim': store.features.shape[1],
+            'memory_mb': round(store.features.nbytes / 2**20, 2),
+            'search_ms_per_image': round(search_time * 1000, 3),
+            'room_match_percentage': round((df['true_room'] == pd.Series(found_rooms, index=df.index)).mean() * 100, 2),
+        })
+
+    results = pd.DataFrame(results)
+    print("=" * 40)
+    print(results.to_string(index=False))
+    print("=" * 40)
+    return results
 
 
 def print_statistics(df: pd.DataFrame, toggle: bool, save_path: str = None) -> None:
@@ -77,7 +181,7 @@ if __name__ == "__main__":
     df_full['position_id'] = df_full['position_id'].astype(int)
 
 
-    diagnostics_toggle = 'single'   # 'single' or 'multi'
+    diagnostics_toggle = 'single'   # 'single', 'multi', 'embedding' or 'ann'
     N_best_matches = 1 #default = 6
     cluster_size = 1 #default = 3
 
@@ -87,9 +191,10 @@ if __name__ == "__main__":
     
     if diagnostics_toggle == 'single':
         # For individual images
-        df_full[['found_room', 'calculation_time']] = df_full['user_image_name'].apply(
-            lambda x: get_room_name_and_time(x, rooms_json_path, N_best_matches, cluster_size)
+        df_full[['center_coords', 'calculation_time']] = df_full['user_image_name'].apply(
+            lambda x: get_center_and_time(x, N_best_matches, cluster_size)
         ).apply(pd.Series)
+        df_full = add_found_rooms(df_full, rooms_json_path)
 
         print_statistics(df_full, toggle=diagnostics_toggle, save_path=diagnostics_csv_path)
     
@@ -102,8 +207,17 @@ if __name__ == "__main__":
 
         filtered_df = grouped_df[grouped_df['user_image_name'].apply(len) >= 2].copy()
 
-        filtered_df[['found_room', 'calculation_time']] = filtered_df['user_image_name'].apply(
-            lambda x: get_room_name_and_time(x, rooms_json_path, N_best_matches, cluster_size)
+        filtered_df[['center_coords', 'calculation_time']] = filtered_df['user_image_name'].apply(
+            lambda x: get_center_and_time(x, N_best_matches, cluster_size)
         ).apply(pd.Series)
+        filtered_df = add_found_rooms(filtered_df, rooms_json_path)
 
         print_statistics(filtered_df, toggle=diagnostics_toggle, save_path=diagnostics_csv_path)
+
+    elif diagnostics_toggle == 'embedding':
+        # Accuracy, size and search time of every embedding head on the single images
+        compare_embedding_heads(df_full, rooms_json_path, N_best_matches, cluster_size)
+
+    elif diagnostics_toggle == 'ann':
+        # Recall@N of the ANN index and the quantized codes against exact search
+        compare_ann_search(df_full, N_best_matches)
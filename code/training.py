@@ -1,33 +1,171 @@
+import hashlib
 import os
-import pickle
+import re
+import shutil
+
+import numpy as np
 import torch
 import torchvision.models as models
 import torchvision.transforms as transforms
 from PIL import Image
+from torch.utils.data import DataLoader, Dataset
 from tqdm import tqdm
+
+from API.ann_index import ANN_MIN_ROWS, build_ivf_index
+from API.CNN import build_reference_coordinates, build_reference_matrix
+from API.embedding import EmbeddingHead, fit_embedding_head
+from API.feature_store import (
+    feature_store_exists,
+    load_feature_store,
+    save_feature_store,
+)
+from API.quantization import fit_codec
+
 # from const import GROUND_TRUTH_PATH, USER_IMAGE_PATH, CACHE_PATH  # Import path variables from const.py
 
+# Folder in the output directory holding the shards of an unfinished run
+CHECKPOINT_DIR = "extraction_checkpoint"
+
+
+# Decodes and resizes reference images in the DataLoader worker processes
+class ReferenceImageDataset(Dataset):
+    def __init__(self, image_paths, transform):
+        self.image_paths = image_paths
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, index):
+        img = Image.open(self.image_paths[index]).convert("RGB")
+        return self.transform(img)
+
+
+# Finished shards by number, temporary files of an interrupted write are
+# left out
+def checkpoint_shards(checkpoint_dir):
+    shards = {}
+    for name in os.listdir(checkpoint_dir):
+        match = re.fullmatch(r"shard_(\d+)\.npz", name)
+        if match:
+            shards[int(match[1])] = os.path.join(checkpoint_dir, name)
+    return dict(sorted(shards.items()))
+
+
+# Features of finished shards by image name, with the hash they were taken from
+def load_checkpoint_shards(checkpoint_dir):
+    extracted = {}
+    for shard_path in checkpoint_shards(checkpoint_dir).values():
+        with np.load(shard_path) as shard:
+            for name, sha256, features in zip(
+                shard["names"], shard["sha256"], shard["features"]
+            ):
+                extracted[str(name)] = (str(sha256), features)
+    return extracted
+
+
+# Write the features of the images extracted since the last shard
+def save_checkpoint_shard(checkpoint_dir, names, sources, features):
+    shard_number = 1 + max(checkpoint_shards(checkpoint_dir), default=-1)
+    shard_path = os.path.join(checkpoint_dir, f"shard_{shard_number:05d}")
+    # Written through a file object, np.savez would add .npz to the name
+    with open(shard_path + ".tmp", "wb") as f:
+        np.savez(
+            f,
+            names=np.array(names),
+            sha256=np.array([sources[name]["sha256"] for name in names]),
+            features=np.stack(features),
+        )
+    os.replace(shard_path + ".tmp", shard_path + ".npz")
+
+
+# Extract the features of many images with parallel decoding and batched
+# forward passes, checkpointing them to shards so a rerun can resume
+def extract_vgg16_features_batched(
+    GROUND_TRUTH_PATH,
+    names,
+    sources,
+    model,
+    transform,
+    checkpoint_dir,
+    batch_size=32,
+    num_workers=4,
+    checkpoint_every=512,
+):
+    os.makedirs(checkpoint_dir, exist_ok=True)
+
+    # Reuse the shards of an interrupted run for images that did not change
+    extracted = {
+        name: features
+        for name, (sha256, features) in load_checkpoint_shards(
+            checkpoint_dir
+        ).items()
+        if name in sources and sources[name]["sha256"] == sha256
+    }
+    remaining = [name for name in names if name not in extracted]
+    if extracted:
+        print(f"resuming with {len(extracted)} images from checkpoint shards")
+
+    loader = DataLoader(
+        ReferenceImageDataset(
+            [os.path.join(GROUND_TRUTH_PATH, name) for name in remaining],
+            transform,
+        ),
+        batch_size=batch_size,
+        num_workers=num_workers,
+    )
+
+    shard_names, shard_features = [], []
+    with torch.inference_mode():
+        for batch_index, batch in enumerate(tqdm(loader)):
+            features = model(batch).flatten(start_dim=1).numpy()
+
+            start = batch_index * batch_size
+            shard_names.extend(remaining[start : start + len(features)])
+            shard_features.extend(features)
+
+            if len(shard_names) >= checkpoint_every:
+                save_checkpoint_shard(
+                    checkpoint_dir, shard_names, sources, shard_features
+                )
+                extracted.update(zip(shard_names, shard_features))
+                shard_names, shard_features = [], []
+
+    extracted.update(zip(shard_names, shard_features))
+    return [extracted[name] for name in names]
+
+
+# Size, modification time and content hash of a reference image, the hash
+# is reused from the previous build when size and mtime did not change
+def get_image_fingerprint(image_path, previous=None):
+    stat = os.stat(image_path)
+    fingerprint = {"size": stat.st_size, "mtime": stat.st_mtime}
+
+    if previous and all(previous.get(k) == v for k, v in fingerprint.items()):
+        fingerprint["sha256"] = previous["sha256"]
+        return fingerprint
 
-# Extract image features using the VGG16 model
-def extract_vgg16_features(image_path, model, transform):
-    # Load and process the image, resizing it to VGG16's input size (224x224)
-    img = Image.open(image_path).convert("RGB")
-    img = transform(img)
-    img = img.unsqueeze(0)  # Add batch dimension
+    with open(image_path, "rb") as f:
+        fingerprint["sha256"] = hashlib.sha256(f.read()).hexdigest()
+    return fingerprint
 
-    # Extract features
-    with torch.no_grad():
-        features = model(img)
 
-    features = (
-        features.flatten().numpy()
-    )  # Convert PyTorch tensor to numpy array and flatten
-    return features
+# Split the current images into unchanged, new or changed, and deleted ones
+def plan_incremental_update(sources, previous_sources):
+    unchanged = [
+        name
+        for name, fingerprint in sources.items()
+        if name in previous_sources
+        and previous_sources[name]["sha256"] == fingerprint["sha256"]
+    ]
+    unchanged_names = set(unchanged)
+    to_extract = [name for name in sources if name not in unchanged_names]
+    deleted = [name for name in previous_sources if name not in sources]
+    return unchanged, to_extract, deleted
 
 
-# Function to preprocess reference images and save features
-def preprocess_reference_images(GROUND_TRUTH_PATH, output_file):
-    # Load the pretrained VGG16 model and remove the classification layer
+# Load the pretrained VGG16 model without its classification layers
+def load_vgg16_model():
     model = models.vgg16(pretrained=True)
     model = torch.nn.Sequential(
         *list(model.children())[:-1]
@@ -44,36 +182,200 @@ def preprocess_reference_images(GROUND_TRUTH_PATH, output_file):
             ),
         ]
     )
+    return model, transform
+
 
+# Function to preprocess reference images and save them as a feature store
+def preprocess_reference_images(
+    GROUND_TRUTH_PATH,
+    output_dir,
+    csv_path,
+    embedding="raw",
+    n_components=256,
+    ann_index="ivf",
+    codec=None,
+    incremental=False,
+    batch_size=32,
+    num_workers=4,
+    num_threads=None,
+):
+    """
+    With `incremental`, an existing store in `output_dir` is updated:
+    only new and changed images are extracted, deleted images are dropped
+    and the stored embedding head and codec are reused. The index is
+    rebuilt over all rows. Without a usable store everything is extracted.
+
+    Images are decoded in `num_workers` DataLoader processes and run
+    through VGG16 in batches of `batch_size` on `num_threads` torch
+    threads. Finished batches are checkpointed to shards in the output
+    directory, so an interrupted run resumes where it stopped.
+    """
     # Create cache folder if it doesn't exist
     # os.makedirs(CACHE_PATH, exist_ok=True)
 
-    # Load reference images and extract VGG16 features
-    ref_image_paths = [
-        os.path.join(GROUND_TRUTH_PATH, img)
-        for img in os.listdir(GROUND_TRUTH_PATH)
-    ]
+    # Fingerprint the reference images, reusing the hashes of the last build
+    store = None
+    previous_sources = {}
+    if incremental and feature_store_exists(output_dir):
+        store = load_feature_store(output_dir, use_index=False)
+        previous_sources = store.manifest.get("sources", {})
+
+        if (
+            store.manifest.get("embedding", {}).get("head", "raw")
+            != embedding
+        ):
+            print("embedding head changed, rebuilding the whole store")
+            store, previous_sources = None, {}
+
+    sources = {
+        img: get_image_fingerprint(
+            os.path.join(GROUND_TRUTH_PATH, img), previous_sources.get(img)
+        )
+        for img in sorted(os.listdir(GROUND_TRUTH_PATH))
+    }
+    unchanged, to_extract, deleted = plan_incremental_update(
+        sources, previous_sources
+    )
+    print(
+        f"{len(unchanged)} unchanged, {len(to_extract)} new or changed and "
+        f"{len(deleted)} deleted reference images"
+    )
+
+    # Stores below ANN_MIN_ROWS are saved without an index, the store keeps
+    # all current images
+    index_kind = (
+        "ivf"
+        if ann_index == "ivf" and len(sources) >= ANN_MIN_ROWS
+        else "exact"
+    )
+    settings_changed = store is not None and (
+        store.manifest.get("index", {}).get("kind") != index_kind
+        or store.manifest.get("quantization", {}).get("kind")
+        != (codec or "none")
+    )
+    if store is not None and not (to_extract or deleted or settings_changed):
+        print(f"Reference store {output_dir} is up to date")
+        return
+
+    # Threads of the forward passes, torch picks its default without
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+    # Extract VGG16 features of the new and changed images
+    ref_vgg16_features = []
+    checkpoint_dir = os.path.join(output_dir, CHECKPOINT_DIR)
+    if to_extract:
+        model, transform = load_vgg16_model()
+        ref_vgg16_features = extract_vgg16_features_batched(
+            GROUND_TRUTH_PATH,
+            to_extract,
+            sources,
+            model,
+            transform,
+            checkpoint_dir,
+            batch_size,
+            num_workers,
+        )
 
-    ref_vgg16_features = []  # List to store extracted feature vectors
+    if store is None:
+        # Fit the embedding head on the reference features
+        embedding_head = fit_embedding_head(
+            embedding, ref_vgg16_features, n_components
+        )
+        ref_image_paths = to_extract
+        ref_features = build_reference_matrix(
+            embedding_head.apply(ref_vgg16_features)
+        )
+        quantizer = None
 
-    for image_path in tqdm(ref_image_paths):
-        # Extract VGG16 features
-        features = extract_vgg16_features(image_path, model, transform)
-        ref_vgg16_features.append(features)
+    else:
+        # Keep the rows of unchanged images, new rows go through the same head
+        embedding_head = store.embedding_head or EmbeddingHead("raw")
+        row_ids = {name: i for i, name in enumerate(store.image_names)}
+        ref_image_paths = unchanged + to_extract
+        ref_features = store.features[[row_ids[img] for img in unchanged]]
 
-    # Save extracted VGG16 features and image paths to a file
-    with open(output_file, "wb") as f:
-        ref_image_paths = [
-            os.path.basename(path) for path in ref_image_paths
-        ]  # Save only basename of the file so it won't depend on OS file system
-        pickle.dump((ref_image_paths, ref_vgg16_features), f)
+        if ref_vgg16_features:
+            ref_features = np.concatenate(
+                [
+                    ref_features,
+                    build_reference_matrix(
+                        embedding_head.apply(ref_vgg16_features)
+                    ),
+                ]
+            )
 
-    print(f"Reference images processed and saved to {output_file}")
+        # Reuse the fitted codec, all rows are encoded again when saving
+        quantizer = store.codec
+        if quantizer is not None and quantizer.kind != codec:
+            quantizer = None
+
+    # Cluster the stored rows into an inverted file index for the API, small
+    # stores are searched exactly
+    index = None
+    if index_kind == "ivf":
+        index = build_ivf_index(ref_features)
+    elif ann_index == "ivf":
+        print(
+            f"skipping ivf index, {len(ref_features)} rows are below "
+            f"ANN_MIN_ROWS={ANN_MIN_ROWS}"
+        )
+
+    # Encode the rows with a compact codec, searched before an exact re-rank
+    if quantizer is None and codec:
+        quantizer = fit_codec(codec, ref_features)
+
+    # Save the features with the image names and their SLAM coordinates
+    save_feature_store(
+        output_dir,
+        ref_image_paths,
+        ref_features,
+        build_reference_coordinates(ref_image_paths, csv_path),
+        extra={"sources": {img: sources[img] for img in ref_image_paths}},
+        embedding_head=embedding_head if embedding != "raw" else None,
+        ann_index=index,
+        codec=quantizer,
+    )
+
+    # The store is complete, the shards of this run are no longer needed
+    shutil.rmtree(checkpoint_dir, ignore_errors=True)
+
+    print(f"Reference images processed and saved to {output_dir}")
 
 
 # Start processing
 if __name__ == "__main__":
     ground_truth_path = os.path.join("data", "BK_slam_images2")
-    output_file = os.path.join("data", "training", "model.pkl")
+    output_dir = os.path.join("data", "training", "reference_store")
+    csv_path = os.path.join("API", "data", "slam_coordinates.csv")
 
-    preprocess_reference_images(ground_truth_path, output_file)
+    # "raw", "gap", "pca" or "gap_pca", compare them with code/room_validation.py
+    embedding = "raw"
+
+    # "ivf" or "exact", check the recall with code/room_validation.py, only
+    # stores of ANN_MIN_ROWS rows or more get an index
+    ann_index = "ivf"
+
+    # None, "sq8" (1 byte per dimension) or "pq" (64 bytes per row)
+    codec = None
+
+    # Only extract new and changed images when the store already exists
+    incremental = True
+
+    # Parallel image decoding and batched forward passes
+    batch_size = 32
+    num_workers = 4
+    num_threads = os.cpu_count()
+
+    preprocess_reference_images(
+        ground_truth_path,
+        output_dir,
+        csv_path,
+        embedding,
+        ann_index=ann_index,
+        codec=codec,
+        incremental=incremental,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        num_threads=num_threads,
+    )